@@ -7,3 +7,14 @@ __version__ = "1.0.0"
 __package__ = "flask_gatekeeper"
 
 from .gatekeeper import GateKeeper
+from .clients import ClientTable
+from .clocks import CoarseClock, FakeClock
+from .storage import MemoryStorage, RedisStorage, SharedMemoryStorage, Storage
+from .middleware import GateKeeperMiddleware
+from .metrics import Metrics
+from .reaper import Reaper
+from .subnets import SubnetLimiter
+from .access import CIDRList
+from .snapshots import Snapshotter
+from .journal import Journal
+from .sketch import CountMinSketch, HeavyHitters
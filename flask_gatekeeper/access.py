@@ -0,0 +1,54 @@
+"""Static allow and deny lists of networks, checked before any rule.
+"""
+import ipaddress
+import socket
+from bisect import bisect_right
+
+
+class CIDRList:
+    __slots__ = ("cidrs", "_ranges")
+
+    def __init__(self, cidrs):
+        """Immutable set of networks, compiled for fast lookups of an IP.
+
+        The networks of each family are merged into sorted, disjoint ranges of addresses,
+        so a lookup is a binary search on the start of the ranges, whatever the number of networks.
+
+        Args:
+            cidrs (iterable): networks (e.g. "10.0.0.0/8", "2001:db8::/32") or single addresses.
+        """
+        self.cidrs = tuple(cidrs)
+        ranges = {socket.AF_INET: [], socket.AF_INET6: []}
+        for cidr in self.cidrs:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+            family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+            ranges[family].append((int(network.network_address), int(network.broadcast_address)))
+
+        # family -> (starts, ends) of the merged ranges
+        self._ranges = {}
+        for family, spans in ranges.items():
+            starts, ends = [], []
+            for start, end in sorted(spans):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self._ranges[family] = (starts, ends)
+
+    def __len__(self):
+        return len(self.cidrs)
+
+    def __contains__(self, ip: str) -> bool:
+        if not ip or not isinstance(ip, str):  # e.g. no REMOTE_ADDR
+            return False
+        family = socket.AF_INET6 if ":" in ip else socket.AF_INET
+        starts, ends = self._ranges[family]
+        if not starts:
+            return False
+        try:
+            address = int.from_bytes(socket.inet_pton(family, ip), "big")
+        except (OSError, ValueError):
+            return False
+        i = bisect_right(starts, address) - 1
+        return i >= 0 and address <= ends[i]
@@ -0,0 +1,294 @@
+"""Rate limiting algorithms available to GateKeeper.
+
+Each algorithm is built from the `rate_limit_rules` of a GateKeeper instance, and works on a per-client state it creates with `new_state()`:
+- `check(state, now)` returns `(count, window, retry)` for the first rule the client is over, or None,
+- `record(state, now)` adds a request made at `now` to the state,
+- `check_traced(state, now, timings)` is the same as check, adding the ns spent on each rule to `timings` (see GateKeeper hooks),
+- `export_state(state, shift)` and `import_state(values, shift)` convert a state to and from a list of numbers,
+  moving its times by `shift` seconds (to save it with wall clock times, see flask_gatekeeper.snapshots).
+
+The states of the constant memory algorithms are flat sequences of numbers, so they can also live in a shared buffer.
+"""
+from array import array
+from time import perf_counter_ns
+
+
+class TimestampRing:
+    __slots__ = ("capacity", "times", "start", "size")
+
+    def __init__(self, capacity: int):
+        """Ring buffer of sorted integer timestamps (in ms), keeping the last `capacity` ones.
+
+        Timestamps are stored in a typed array (8 bytes each, instead of a boxed float and its pointer).
+        The array starts small and doubles as needed up to `capacity`, so a client making a few requests stays small.
+
+        Args:
+            capacity (int): maximum number of timestamps kept, older ones are overwritten.
+        """
+        self.capacity = capacity
+        self.times = array("q", bytes(8 * min(capacity, 4)))
+        self.start = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        """i-th oldest timestamp, or -i-th most recent for negative i"""
+        if i < 0:
+            i += self.size
+        return self.times[(self.start + i) % len(self.times)]
+
+    def __iter__(self):
+        """timestamps from the oldest to the most recent"""
+        times, start, allocated = self.times, self.start, len(self.times)
+        return (times[(start + i) % allocated] for i in range(self.size))
+
+    def append(self, timestamp: int):
+        times = self.times
+        allocated = len(times)
+        if self.size < allocated:
+            times[(self.start + self.size) % allocated] = timestamp
+            self.size += 1
+        elif allocated < self.capacity:
+            # unroll the ring in a bigger array
+            grown = times[self.start:] + times[:self.start]
+            grown.frombytes(bytes(8 * (min(allocated * 2, self.capacity) - allocated)))
+            grown[allocated] = timestamp
+            self.times, self.start = grown, 0
+            self.size += 1
+        else:
+            times[self.start] = timestamp
+            self.start = (self.start + 1) % allocated
+
+    def count_before(self, timestamp: int) -> int:
+        """number of timestamps strictly older than `timestamp`, by bisection"""
+        low, high = 0, self.size
+        times, start, allocated = self.times, self.start, len(self.times)
+        while low < high:
+            middle = (low + high) // 2
+            if times[(start + middle) % allocated] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def count_since(self, timestamp: int) -> int:
+        """number of timestamps at or after `timestamp`"""
+        return self.size - self.count_before(timestamp)
+
+    def drop_before(self, timestamp: int):
+        """forgets the timestamps strictly older than `timestamp`"""
+        dropped = self.count_before(timestamp)
+        if dropped:
+            self.start = (self.start + dropped) % len(self.times)
+            self.size -= dropped
+
+
+class SlidingLog:
+    name = "sliding-log"
+
+    def __init__(self, rules: list):
+        """Exact rolling window, keeping the timestamp of the last requests of each client.
+
+        Timestamps are kept as integer ms in a TimestampRing, so memory per client grows with the largest rule count (8 bytes per request).
+
+        Args:
+            rules (list): rate limit rules [{"count":int,"window":int},..]
+        """
+        # (count, window, window in ms)
+        self.rules = [(r["count"], r["window"], int(r["window"] * 1000)) for r in rules]
+        self.max_count = max(count for count, _, _ in self.rules)
+        self.max_window = max(window for _, window, _ in self.rules)
+        self.max_window_ms = int(self.max_window * 1000)
+
+    def new_state(self):
+        return TimestampRing(self.max_count)
+
+    def check(self, entries, now):
+        now_ms = int(now * 1000)
+        # entries older than our largest window can't count towards any rule anymore
+        entries.drop_before(now_ms - self.max_window_ms)
+
+        # entries are sorted, so there are at least `count` entries in the last `window`
+        # if the count-th most recent one is in that window. No need to go through the others.
+        entries_len = len(entries)
+        for count, window, window_ms in self.rules:
+            if entries_len >= count:
+                nth_entry = entries[-count]
+                if nth_entry >= now_ms - window_ms:
+                    return count, window, int((nth_entry + window_ms) / 1000 - now)
+        return None
+
+    def check_traced(self, entries, now, timings):
+        start = perf_counter_ns()
+        now_ms = int(now * 1000)
+        entries.drop_before(now_ms - self.max_window_ms)  # counted in the first rule
+        entries_len = len(entries)
+        for count, window, window_ms in self.rules:
+            rate_limited = None
+            if entries_len >= count:
+                nth_entry = entries[-count]
+                if nth_entry >= now_ms - window_ms:
+                    rate_limited = count, window, int((nth_entry + window_ms) / 1000 - now)
+            end = perf_counter_ns()
+            timings[rule_phase(count, window)] = end - start
+            start = end
+            if rate_limited:
+                return rate_limited
+        return None
+
+    def record(self, entries, now):
+        entries.append(int(now * 1000))
+
+    def export_state(self, entries, shift):
+        shift_ms = int(shift * 1000)
+        return [timestamp + shift_ms for timestamp in entries]
+
+    def import_state(self, values, shift):
+        entries, shift_ms = self.new_state(), int(shift * 1000)
+        for timestamp in values[-self.max_count:]:
+            entries.append(int(timestamp) + shift_ms)
+        return entries
+
+
+class SlidingWindowCounter:
+    name = "sliding-window-counter"
+
+    def __init__(self, rules: list):
+        """Approximated rolling window, keeping a request counter for the current and previous window of each rule.
+
+        The count over the rolling window is estimated as the current counter
+        plus the previous one weighted by how much of the previous window is still in the rolling one.
+        Memory per client is 3 numbers per rule, whatever the rule counts.
+
+        Args:
+            rules (list): rate limit rules [{"count":int,"window":int},..]
+        """
+        self.rules = [(r["count"], r["window"]) for r in rules]
+        self.max_window = max(window for _, window in self.rules)
+
+    def new_state(self):
+        # [window index, current counter, previous counter] for each rule
+        return [0, 0, 0] * len(self.rules)
+
+    @staticmethod
+    def _roll(state, i, bucket):
+        """move the counters of rule i to the window `bucket`"""
+        if state[i] != bucket:
+            state[i + 2] = state[i + 1] if state[i] == bucket - 1 else 0
+            state[i + 1] = 0
+            state[i] = bucket
+
+    def check(self, state, now):
+        for i, (count, window) in enumerate(self.rules):
+            i *= 3
+            bucket = int(now // window)
+            self._roll(state, i, bucket)
+            current, previous = state[i + 1], state[i + 2]
+            elapsed = now - bucket * window
+            if previous * (1 - elapsed / window) + current >= count:
+                if current >= count:
+                    # the current counter will be the previous one of the next window
+                    retry = (window - elapsed) + window * (1 - count / current)
+                else:
+                    retry = window * (1 - (count - current) / previous) - elapsed
+                return count, window, int(retry)
+        return None
+
+    def check_traced(self, state, now, timings):
+        start = perf_counter_ns()
+        for i, (count, window) in enumerate(self.rules):
+            rate_limited = None
+            i *= 3
+            bucket = int(now // window)
+            self._roll(state, i, bucket)
+            current, previous = state[i + 1], state[i + 2]
+            elapsed = now - bucket * window
+            if previous * (1 - elapsed / window) + current >= count:
+                if current >= count:
+                    retry = (window - elapsed) + window * (1 - count / current)
+                else:
+                    retry = window * (1 - (count - current) / previous) - elapsed
+                rate_limited = count, window, int(retry)
+            end = perf_counter_ns()
+            timings[rule_phase(count, window)] = end - start
+            start = end
+            if rate_limited:
+                return rate_limited
+        return None
+
+    def record(self, state, now):
+        for i, (_, window) in enumerate(self.rules):
+            i *= 3
+            self._roll(state, i, int(now // window))
+            state[i + 1] += 1
+
+    def export_state(self, state, shift):
+        # window indexes are turned into the start time of the window
+        values = list(state)
+        for i, (_, window) in enumerate(self.rules):
+            values[3 * i] = state[3 * i] * window + shift
+        return values
+
+    def import_state(self, values, shift):
+        # windows can't be realigned exactly, the counters are moved to the nearest window
+        state = [int(value) for value in values]
+        for i, (_, window) in enumerate(self.rules):
+            state[3 * i] = int((values[3 * i] + shift) / window + 0.5)
+        return state
+
+
+class GCRA:
+    name = "gcra"
+
+    def __init__(self, rules: list):
+        """Generic cell rate algorithm (a token bucket), keeping a theoretical arrival time per rule for each client.
+
+        Requests are spaced by window/count seconds on average, with bursts of up to `count` requests.
+        Memory per client is 1 number per rule, whatever the rule counts.
+
+        Args:
+            rules (list): rate limit rules [{"count":int,"window":int},..]
+        """
+        # (count, window, emission interval, burst tolerance)
+        self.rules = [(r["count"], r["window"], r["window"] / r["count"], r["window"] - r["window"] / r["count"]) for r in rules]
+        self.max_window = max(window for _, window, _, _ in self.rules)
+
+    def new_state(self):
+        return [0.0] * len(self.rules)
+
+    def check(self, state, now):
+        for i, (count, window, _, tolerance) in enumerate(self.rules):
+            if state[i] - now > tolerance:
+                return count, window, int(state[i] - tolerance - now)
+        return None
+
+    def check_traced(self, state, now, timings):
+        start = perf_counter_ns()
+        for i, (count, window, _, tolerance) in enumerate(self.rules):
+            rate_limited = (count, window, int(state[i] - tolerance - now)) if state[i] - now > tolerance else None
+            end = perf_counter_ns()
+            timings[rule_phase(count, window)] = end - start
+            start = end
+            if rate_limited:
+                return rate_limited
+        return None
+
+    def record(self, state, now):
+        for i, (_, _, interval, _) in enumerate(self.rules):
+            state[i] = max(state[i], now) + interval
+
+    def export_state(self, state, shift):
+        return [tat + shift if tat else 0.0 for tat in state]
+
+    def import_state(self, values, shift):
+        return [tat + shift if tat else 0.0 for tat in values]
+
+
+def rule_phase(count, window) -> str:
+    """name of the phase of a rule check in the timings of a traced request"""
+    return "rule {}/{}s".format(count, window)
+
+
+ALGORITHMS = {algorithm.name: algorithm for algorithm in (SlidingLog, SlidingWindowCounter, GCRA)}
@@ -0,0 +1,123 @@
+"""micro-benchmarks of the request hot path of flask-gatekeeper
+
+Run with `python -m flask_gatekeeper.bench_gatekeeper` (`--help` for the sweeps).
+Each line reports the cost of one call in ns/op, and the memory used per tracked client.
+"""
+import argparse
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+from flask import Flask, request
+
+from .gatekeeper import GateKeeper
+
+
+def ip_of(i: int) -> str:
+    return "10.{}.{}.{}".format(i >> 16 & 255, i >> 8 & 255, i & 255) if i < 1 << 24 else "fd00::{:x}".format(i)
+
+
+def make_gatekeeper(rules: int, count: int, clients: int, algorithm: str):
+    """GateKeeper instance with `rules` rate limiting rules, around an app with a plain and a specific route"""
+    app = Flask(__name__)
+    # with few clients and low counts, most of the calls go through the rate limited path
+    rate_limit_rules = [{"count": count * (i + 1), "window": 1 + i} for i in range(rules)]
+    gk = GateKeeper(app, ip_header="x-ip", ban_rule={"count": 3, "window": 60, "duration": 60},
+                    rate_limit_rules=rate_limit_rules, algorithm=algorithm, max_clients=max(clients, 1))
+
+    @app.route("/ping")
+    def ping():
+        return "ok"
+
+    @app.route("/specific")
+    @gk.specific(rate_limit_rules=rate_limit_rules)
+    def specific():
+        return "ok"
+    return app, gk, specific
+
+
+def timed(func, ips, ops: int, threads: int = 1, context=None) -> float:
+    """returns the ns per call of func(ip), over `ops` calls spread on `threads` threads
+
+    If set, each thread runs the calls within context() (e.g. a request context).
+    """
+    per_thread = ops // threads
+
+    def run(offset):
+        n = len(ips)
+        with context() if context else nullcontext():
+            for i in range(per_thread):
+                func(ips[(offset + i) % n])
+
+    workers = [threading.Thread(target=run, args=(t * 7919,)) for t in range(threads)]
+    start = time.perf_counter_ns()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return (time.perf_counter_ns() - start) / (per_thread * threads)
+
+
+def bytes_per_client(rules: int, count: int, algorithm: str, clients: int = 10_000) -> float:
+    """tracemalloc'd memory of `clients` new clients, per client"""
+    _, gk, _ = make_gatekeeper(rules, count, clients, algorithm)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(clients):
+        gk._is_ip_rate_limited(ip_of(i))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / clients
+
+
+def bench(rules: int, count: int, clients: int, threads: int, algorithm: str, ops: int):
+    app, gk, specific = make_gatekeeper(rules, count, clients, algorithm)
+    # clients are tracked before timing, so that the table has its size
+    for i in range(clients):
+        gk._is_ip_rate_limited(ip_of(i))
+    ips = [ip_of(random.randrange(max(clients, 1))) for _ in range(min(ops, 100_000))]
+
+    def before_request(ip):
+        request.environ["HTTP_X_IP"] = ip
+        gk._before_request()
+
+    def specific_wrapper(ip):
+        request.environ["HTTP_X_IP"] = ip
+        specific()
+
+    context = lambda: app.test_request_context("/ping")  # noqa: E731
+    results = {
+        "_before_request": timed(before_request, ips, ops, threads, context),
+        "_is_ip_rate_limited": timed(gk._is_ip_rate_limited, ips, ops, threads),
+        "_is_ip_banned": timed(gk._is_ip_banned, ips, ops, threads),
+        "specific()": timed(specific_wrapper, ips, ops, threads, context),
+    }
+    per_client = bytes_per_client(rules, count, algorithm)
+
+    for name, ns in results.items():
+        print("{:<20} algorithm={:<22} rules={:<3} count={:<7} clients={:<9} threads={:<3} {:>10.0f} ns/op {:>8.0f} B/client".format(
+            name, algorithm, rules, count, clients, threads, ns, per_client))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rules", type=int, nargs="+", default=[1, 4, 16], help="number of rate limiting rules")
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 1000, 100000], help="count of the rules")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10_000, 1_000_000], help="distinct IPs tracked (up to 10M)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4], help="threads calling concurrently")
+    parser.add_argument("--algorithms", nargs="+", default=["sliding-log", "sliding-window-counter", "gcra"])
+    parser.add_argument("--ops", type=int, default=50_000, help="calls per measure")
+    args = parser.parse_args()
+
+    for algorithm in args.algorithms:
+        for rules in args.rules:
+            for count in args.counts:
+                for clients in args.clients:
+                    for threads in args.threads:
+                        bench(rules, count, clients, threads, algorithm, args.ops)
+
+
+if __name__ == "__main__":
+    main()
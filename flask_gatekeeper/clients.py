@@ -0,0 +1,181 @@
+"""Bounded table of the clients tracked by a GateKeeper instance.
+"""
+import threading
+from collections import OrderedDict
+
+from .clocks import monotonic
+
+# seconds between two looks at the held records, for the ones to put back in the table
+HELD_SWEEP_INTERVAL = 1.0
+
+
+class ClientTable:
+    def __init__(self, max_size: int = 100_000, ttl: float = None, clock=monotonic):
+        """Mapping of client IP -> record, with a hard cap on the number of entries.
+
+        Records can be any object with a writable `last_seen` attribute, which the table sets on each access.
+
+        Records are kept in least-recently-used order:
+        - records not seen for more than `ttl` seconds are dropped when a new client is added,
+        - when the table is full, the least recently used record is evicted to make room for the new one.
+
+        Looking up a tracked client is lock-free, only adding a client (and dropping others to make room) is done under a lock,
+        so the table can be shared by the threads of a threaded WSGI server.
+
+        Beware that evicting a record also forgets its reports, so `max_size` should be sized well above
+        the number of clients you expect in a `ttl` period. Pinned records (see `pinned`, e.g. banned clients) are never evicted nor expired:
+        they are held aside, out of the least-recently-used order and of `max_size`, until they are seen again or unpinned.
+
+        Args:
+            max_size (int, optional): maximum number of records to keep. Defaults to 100 000.
+            ttl (float, optional): seconds of inactivity after which a record is dropped. Defaults to None (never expire).
+            clock (callable, optional): clock to read when no time is given (see flask_gatekeeper.clocks). Defaults to the monotonic clock.
+        """
+        if max_size < 1:
+            raise ValueError("max_size should be at least 1")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # optional callable(ip) returning a record to start from for a new client (e.g. restored from a snapshot), or None
+        self.loader = None
+        # optional callable(record, now) returning whether an idle record should be kept anyway (e.g. a banned client)
+        self.pinned = None
+        self.evictions = 0
+        self.expirations = 0
+        self._records = OrderedDict()  # ip -> record, least recently seen first
+        self._held = {}  # ip -> pinned record pushed out of _records
+        self._held_swept = float("-inf")
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records) + len(self._held)
+
+    def __contains__(self, ip):
+        return ip in self._records or ip in self._held
+
+    def __getitem__(self, ip):
+        record = self.get(ip)
+        if record is None:
+            raise KeyError(ip)
+        return record
+
+    def __iter__(self):
+        return iter([ip for ip, _ in self.items()])
+
+    def values(self) -> list:
+        """Returns a snapshot of the records, the held ones first, then the others least recently seen first."""
+        return list(self._held.values()) + list(self._records.values())
+
+    def items(self) -> list:
+        """Returns a snapshot of the (ip, record) pairs, the held ones first, then the others least recently seen first."""
+        return list(self._held.items()) + list(self._records.items())
+
+    def get(self, ip, default=None):
+        """Returns the record of `ip` without refreshing it, or `default`."""
+        record = self._records.get(ip)
+        if record is None:
+            record = self._held.get(ip, default)
+        return record
+
+    def lookup(self, ip, now: float = None):
+        """Returns the record of `ip` marked as seen at `now`, or None if the client is not tracked (nor restored by the loader)."""
+        if self.loader is None and ip not in self:
+            return None
+        return self.get_or_create(ip, _untracked, now)
+
+    def get_or_create(self, ip, factory, now: float = None):
+        """Returns the record of `ip`, creating it with `factory()` if needed, and marks it as seen at `now` (defaults to the clock of the table).
+
+        If `factory()` returns None, nothing is added and None is returned.
+        """
+        if now is None:
+            now = self.clock()
+        record = self._records.get(ip)
+        if record is not None:
+            record.last_seen = now
+            try:
+                self._records.move_to_end(ip)
+                return record
+            except KeyError:  # evicted by another thread in the meantime
+                pass
+
+        with self._lock:
+            # new records are the only way for the table to grow, so we only make room here
+            self._expire(now)
+            records = self._records
+            record = records.get(ip)
+            if record is None:
+                record = self._held.pop(ip, None)
+                if record is None:
+                    loader = self.loader
+                    record = loader and loader(ip)
+                    if record is None:
+                        record = factory()
+                        if record is None:
+                            return None
+                pinned = self.pinned
+                while len(records) >= self.max_size:
+                    old_ip, old_record = records.popitem(last=False)
+                    if pinned is not None and pinned(old_record, now):
+                        self._held[old_ip] = old_record
+                    else:
+                        self.evictions += 1
+                records[ip] = record
+            record.last_seen = now
+            return record
+
+    def expire(self, now: float = None, limit: int = None):
+        """Drops the records that have not been seen for more than `ttl` seconds.
+
+        As records are kept in least-recently-used order, only the expired ones are visited.
+        With `limit`, at most `limit` records are dropped, so that the lock is held for a bounded time.
+
+        Returns:
+            int: number of records dropped
+        """
+        with self._lock:
+            return self._expire(self.clock() if now is None else now, limit)
+
+    def _expire(self, now, limit=None):
+        if self._held and now >= self._held_swept + HELD_SWEEP_INTERVAL:
+            self._release(now)
+        if self.ttl is None:
+            return 0
+        deadline = now - self.ttl
+        dropped = 0
+        records = self._records
+        pinned = self.pinned
+        while records and dropped != limit:
+            try:
+                ip, record = next(iter(records.items()))
+            except RuntimeError:  # a lookup moved a record meanwhile
+                continue
+            if record.last_seen >= deadline:
+                break
+            record = records.pop(ip, None)
+            if record is None:
+                continue
+            if pinned is not None and pinned(record, now):
+                self._held[ip] = record
+                continue
+            dropped += 1
+        self.expirations += dropped
+        return dropped
+
+    def _release(self, now):
+        """puts the held records that are not pinned anymore back in the table, as the least recently seen ones"""
+        self._held_swept = now
+        pinned = self.pinned
+        records = self._records
+        for ip in [ip for ip, record in self._held.items() if pinned is None or not pinned(record, now)]:
+            records[ip] = self._held.pop(ip)
+            records.move_to_end(ip, last=False)
+
+    def stats(self) -> dict:
+        """Returns the current size and the eviction counters of the table"""
+        return {"size": len(self), "held": len(self._held), "max_size": self.max_size, "ttl": self.ttl,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+def _untracked():
+    return None
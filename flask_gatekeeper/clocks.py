@@ -0,0 +1,61 @@
+"""Clocks GateKeeper can read the time from.
+
+A clock is any callable returning the current time in seconds, as a float. The storages only compare the times they are given
+with each other, so a clock doesn't need to be the wall clock, as long as every process sharing a storage reads the same one.
+"""
+import threading
+import time
+
+# default clock: not affected by the system clock being set (e.g. an NTP step), and shared by all the processes of a host
+monotonic = time.monotonic
+
+# clock of the storages shared between hosts, assumed to be synchronized
+wall = time.time
+
+
+class CoarseClock:
+    def __init__(self, resolution: float = 0.001, source=monotonic):
+        """Clock ticking every `resolution` seconds, for very high request rates.
+
+        A daemon thread reads `source` every `resolution` seconds, so reading the time is an attribute lookup instead of a call to the system.
+        Windows are then only accurate to `resolution`.
+
+        Args:
+            resolution (float, optional): Seconds between two ticks. Defaults to 1ms.
+            source (callable, optional): Clock to read on each tick. Defaults to the monotonic clock.
+        """
+        self.resolution = resolution
+        self.source = source
+        self.now = source()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._tick, name="gatekeeper-clock", daemon=True)
+        self._thread.start()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def _tick(self):
+        while not self._stopped.wait(self.resolution):
+            self.now = self.source()
+
+    def stop(self):
+        """stops the ticking thread, the clock then stays at its last tick"""
+        self._stopped.set()
+        self._thread.join()
+
+
+class FakeClock:
+    def __init__(self, start: float = 1000.0):
+        """Clock that only moves when told to, for deterministic tests.
+
+        Args:
+            start (float, optional): Time the clock starts at. Defaults to 1000.0.
+        """
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        """moves the clock `seconds` forward"""
+        self.now += seconds
@@ -1,31 +1,37 @@
 """A simple banning & rate limiting extension for Flask.
 """
-import time
-from collections import deque
+import inspect
+import ipaddress
+import os
+import threading
 from functools import wraps
+from time import perf_counter_ns
 
 from flask import Flask, Response, request
 
+from .access import CIDRList
+from .algorithms import ALGORITHMS
+from .clients import ClientTable
+from .metrics import Metrics
+from .reaper import Reaper
+from .sketch import HeavyHitters
+from .snapshots import Snapshotter
+from .storage import MemoryStorage, Storage
+from .subnets import SubnetLimiter
 
-class IP:
-    def __init__(self, ban_count, rate_count):
-        """IP record that keeps track of reports and requests made by that IP.
-
-        Args:
-            ban_count (int): number of reports to keep
-            rate_count (int): number of requests to keep
-        """
-        self.ban_entries = deque(maxlen=ban_count)
-        self.rate_entries = deque(maxlen=rate_count)
-        self.ban_active_until = 0
-
-        # setters
-        self.add_report = lambda: self.ban_entries.append(time.time())
-        self.add_entry = lambda: self.rate_entries.append(time.time())
+# results of GateKeeper._access
+ALLOW = "allow"
+DENY = "deny"
 
 
 class GateKeeper:
-    def __init__(self, app: Flask = None, ban_rule: dict = None, rate_limit_rules: list = None, ip_header: str = None, excluded_methods: list = None):
+    def __init__(self, app: Flask = None, ban_rule: dict = None, rate_limit_rules: list = None, ip_header: str = None, excluded_methods: list = None,
+                 max_clients: int = 100_000, client_ttl: float = None, client_table: ClientTable = None, algorithm: str = "sliding-log",
+                 storage: Storage = None, detailed_responses: bool = True, clock=None,
+                 reap_interval: float = None, metrics: bool = False, on_check_start=None, on_decision=None, trace_every: int = 1000,
+                 subnet_rules: list = None, allowlist: list = None, denylist: list = None,
+                 snapshot_path: str = None, snapshot_interval: float = 60.0, journal_path: str = None, journal_interval: float = 1.0,
+                 fast_path: bool = False, approximate=False):
         """GateKeeper instance around a flask app.
 
         Provides rate-limiting & ban functions.
@@ -46,30 +52,162 @@ class GateKeeper:
         - ban any IP for 600s if it has been reported 3 times in the last 60s,
         - rate limit any IP if it has made more than 20 requests in the last 1s or more than 100 requests in a 10s window.
 
+        subnet_rules apply rate limits to the subnets of the clients on top of the per IP rules, so that a client rotating
+        through the addresses of its /24 or /64 is still limited (see `SubnetLimiter`).
+        It should be a list [{"count":int,"window":int,"ipv4_prefix":int,"ipv6_prefix":int},..], the prefixes defaulting to 24 and 64.
+
+        allowlist and denylist are lists of networks (e.g. "10.0.0.0/8") or addresses, checked before any rule and any client state:
+        clients in the denylist get a 403, clients in the allowlist are let through without being counted (the denylist wins if both match).
+        They are compiled for lookups in O(log n), and can be replaced while serving requests with `.set_allowlist()` and `.set_denylist()`.
+
         If you do not set ban_rule, no banning will be done. Same goes for the rate limiting.
 
+        Bans can also be managed outside of the requests (e.g. from a feed of a SIEM), for many clients at once:
+        `.ban(targets, duration)` and `.unban(targets)` take addresses and networks, `.ban_statuses(ips)` returns the bans of many clients,
+        and `.bans()` iterates the bans in force. This works with or without a ban rule.
+
         Requests made during the rate limiting period or ban period are not counted.
 
         You can delay the init by omitting `app` here and calling `.init_app()` later.
 
         If you set ip_header but the header is not present in the request, it falls back to the client seen by flask (which might be the proxy's IP if using one) string, and any request made by potentially different clients will be added to this.
 
+        The rate limiting rules can be enforced by different algorithms:
+        - "sliding-log" (default) is exact, but keeps the timestamps of the last requests, so memory per client grows with the rule counts,
+        - "sliding-window-counter" estimates the rolling count from a counter for the current and previous window of each rule,
+        - "gcra" (a token bucket) spaces requests by window/count seconds on average, allowing bursts of up to count requests.
+        The last two keep a constant number of values per client and per rule, which is better suited to rules with large counts.
+        For traffic from too many clients to keep a state for each, set `approximate=True`: the rules are then enforced from count-min sketches
+        of a fixed size, which never under-count a client but may over-count it a little (see `HeavyHitters`).
+        `approximate` can also be a dict of options of `HeavyHitters`, e.g. {"error":0.0001,"confidence":0.999,"top":1000}.
+        The clients making the most requests are then listed by `.heavy_hitters.top()`.
+        The sketches are kept in the memory of the process, whatever the storage of the bans.
+
+        Tracked clients are kept in a bounded `ClientTable`: at most `max_clients` records are kept (least recently used ones are evicted first),
+        and records idle for more than `client_ttl` seconds are dropped. By default `client_ttl` is the longest period a record can matter for,
+        i.e. the largest rate limit window or the ban window plus its duration.
+        Idle records are only dropped when new clients come in, set `reap_interval` to also sweep them from a background thread (see `Reaper`).
+        With `fast_path`, clients only get a record when they approach a rule, their first requests being counted in a fixed size sketch
+        (see `MemoryStorage`), so that the many clients making a few requests cost no memory.
+
+        The state of the clients is kept in the memory of the process by default (see `MemoryStorage`).
+        With a pre-forking server (gunicorn, uWSGI..) each worker would then enforce the rules on its own,
+        use `storage=SharedMemoryStorage("myapp-gatekeeper")` to share the state between the workers of a host,
+        or `storage=RedisStorage(redis_client)` to share it between hosts.
+
+        The time is read once per request from `clock`, a callable returning seconds (see flask_gatekeeper.clocks).
+        The default is the monotonic clock, so that setting the system clock doesn't ban or unban anyone, except for RedisStorage
+        which compares times across hosts and uses the wall clock. `clocks.CoarseClock()` avoids reading the system clock on each request,
+        and `clocks.FakeClock()` makes tests deterministic.
+
+        To profile the cost of the global rules, set `on_check_start(request)` and/or `on_decision(request, decision, timings)`.
+        One checked request every `trace_every` is then traced: `on_check_start` is called before checking it, and `on_decision` after,
+        with the decision ("allowed", "banned", "rate_limited", "denied" or "allowlisted") and the ns spent in each phase of the check, e.g.
+        {"ip": .., "lookup": .., "ban": .., "rule 20/1s": .., "record": .., "response": ..}
+        (with a shared memory or Redis storage, or an async app, the storage phases are only "ban" and "rate").
+        Without hooks, the request path is the same as if tracing didn't exist.
+
+        With the memory storage, set `snapshot_path` to keep the bans, reports and rate limiting states across restarts:
+        the state is saved to this file every `snapshot_interval` seconds from a background thread, and when the process exits.
+        `init_app` loads the last snapshot without reading it, each client is restored when it is first seen again (see flask_gatekeeper.snapshots).
+        Rate limiting states are only restored if the rules didn't change. With a pre-forking server, give each worker its own file,
+        or share the state with `SharedMemoryStorage` instead.
+
+        Set `journal_path` to also append every report and ban to a journal (see flask_gatekeeper.journal), replayed by `init_app`,
+        so that bans survive a crash between two snapshots. Events are written every `journal_interval` seconds by a background writer,
+        so `.report()` does no I/O, and the journal is compacted as it grows.
+
         Args:
             app (flask.Flask, optional): Flask app to wrap around. Defaults to None.
             ban_rule (dict, optional): Global ban rule for the whole app. Defaults to None.
             rate_limit_rules (list, optional): Global rate limit rules for the whole app. Defaults to None.
             ip_header (str, optional): Header to check for the IP. useful with a proxy that will add a header with the ip of the actual client. Defaults to request.remote_addr.
             excluded_methods (str, optional): Types of requests to ignore when counting requests. Can be GET, POST, HEAD, OPTIONS.. Defaults to None.
+            max_clients (int, optional): Maximum number of clients to track. Defaults to 100 000.
+            client_ttl (float, optional): Seconds of inactivity after which a client is forgotten. Defaults to the largest window of the rules.
+            client_table (ClientTable, optional): Table to store the clients in, replaces max_clients and client_ttl. Defaults to None.
+            algorithm (str, optional): Rate limiting algorithm, "sliding-log", "sliding-window-counter" or "gcra". Defaults to "sliding-log".
+            storage (Storage, optional): Where to keep the state of the clients, replaces max_clients, client_ttl, client_table and fast_path. Defaults to a MemoryStorage.
+            detailed_responses (bool, optional): Explain the ban/rate limiting in the body of the 403/429 responses, otherwise the body is empty. Defaults to True.
+            clock (callable, optional): Clock to read the time from. Defaults to the default clock of the storage.
+            reap_interval (float, optional): Seconds between two background sweeps of the expired clients. Defaults to None (no sweeps).
+            metrics (bool, optional): Count the decisions and their duration in `.metrics` (see `Metrics`). Defaults to False.
+            on_check_start (callable, optional): Called with the request before a traced check. Defaults to None.
+            on_decision (callable, optional): Called with the request, the decision and the timings of the phases after a traced check. Defaults to None.
+            trace_every (int, optional): Trace one checked request every `trace_every`. Defaults to 1000.
+            subnet_rules (list, optional): Global rate limit rules for the subnets of the clients. Defaults to None.
+            allowlist (list, optional): Networks whose clients are never limited. Defaults to None.
+            denylist (list, optional): Networks whose clients are always rejected. Defaults to None.
+            snapshot_path (str, optional): File to save the state of the clients to, and to restore it from. Defaults to None (no snapshots).
+            snapshot_interval (float, optional): Seconds between two snapshots. Defaults to 60.
+            journal_path (str, optional): File to journal the reports and bans to, and to replay them from. Defaults to None (no journal).
+            journal_interval (float, optional): Seconds between two writes of the journal. Defaults to 1.
+            fast_path (bool, optional): Only track the clients approaching a rate limiting rule. Defaults to False.
+            approximate (bool or dict, optional): Enforce the rate limiting rules from count-min sketches instead of per client states. Defaults to False.
         """
         self.ban_rule = ban_rule
         self.ban_count = ban_rule["count"] if ban_rule else 0
         self.rate_limit_rules = rate_limit_rules
         self.rate_count = max([r["count"] for r in rate_limit_rules]) if rate_limit_rules else 0
+        if algorithm not in ALGORITHMS:
+            raise ValueError("unknown rate limiting algorithm '{}', expected one of {}".format(algorithm, ", ".join(ALGORITHMS)))
+        self.algorithm_name = algorithm
+        self.algorithm = ALGORITHMS[algorithm](rate_limit_rules) if rate_limit_rules else None
 
-        self.excluded_methods = excluded_methods or []
+        self.excluded_methods = frozenset(excluded_methods or ())
         self.ip_header = ip_header
-        self.ips = {}
+        if storage is None:
+            storage = MemoryStorage(max_clients=max_clients, client_ttl=client_ttl, client_table=client_table, fast_path=fast_path)
+        self.clock = clock or storage.default_clock
+        self.heavy_hitters = None
+        if approximate and rate_limit_rules:
+            self.heavy_hitters = HeavyHitters(rate_limit_rules, **(approximate if isinstance(approximate, dict) else {}))
+        # the storage only keeps the bans in the approximate mode
+        storage.bind(self.ban_rule, None if self.heavy_hitters else self.algorithm, self.clock)
+        self.storage = storage
+        # where the per IP rules are checked
+        self.limiter = self.heavy_hitters or storage
+        self.subnets = SubnetLimiter(subnet_rules, storage, algorithm, self.clock) if subnet_rules else None
+        # whether requests go through the rate limiting rules, per IP or per subnet
+        self.checks_rates = bool(rate_limit_rules or subnet_rules)
+        # whether requests go through the ban checks, because of the ban rule or of a ban set by `.ban()`,
+        # which may have been set by another process sharing the storage, unless the storage checks them along the rate limiting rules
+        bans_on_hit = not ban_rule and self.limiter is storage and self.algorithm is not None and storage.check_bans_on_hit()
+        self.checks_bans = bool(ban_rule) or (storage.shared and not bans_on_hit)
+        self.reaper = Reaper(storage, interval=reap_interval).start() if reap_interval else None
+        if (snapshot_path or journal_path) and not isinstance(storage, MemoryStorage):
+            raise ValueError("snapshots and journals are only available with a MemoryStorage, {} keeps its state by itself".format(type(storage).__name__))
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.snapshotter = None
+        self.journal_path = journal_path
+        self.journal_interval = journal_interval
+        self.journal = None
         self.bypass_routes = set()
+        # (endpoint, method) -> whether the global rules apply, resolved on the first request to each
+        self._policies = {}
+        self.response_class = Response
+        self.detailed_responses = detailed_responses
+        # the parts of the responses bodies that only depend on the rules are built once
+        self._deny_body = "ip %s denied"
+        self._ban_body = "ip %s banned for %ss (reported {} times in a {}s window)".format(ban_rule["count"], ban_rule["window"]) if ban_rule else "ip %s banned for %ss"
+        self._rate_limit_bodies = {}
+        self._request = request
+        self.allowlist = self.denylist = None
+        # network -> end of its ban, set by `.ban()`, and the networks still banned compiled for lookups
+        self._network_bans = {}
+        self.banned_networks = None
+        self._network_bans_end = float("inf")
+        self._admin_lock = threading.Lock()
+        self._access_lists = False
+        self.set_allowlist(allowlist)
+        self.set_denylist(denylist)
+        self.metrics = Metrics(self) if metrics else None
+        self.on_check_start = on_check_start
+        self.on_decision = on_decision
+        self.trace_every = trace_every
+        self._trace_countdown = trace_every
+        self._untraced = None  # before request used for the requests that are not traced
         if app:
             self.init_app(app)
 
@@ -82,10 +220,8 @@ class GateKeeper:
         Returns:
             Response: ready to be server response with 403 http code and retry after header
         """
-        ban_response = Response("ip {} banned for {}s (reported {} times in a {}s window)".format(
-            ban_infos["ip"], ban_infos["retry"], ban_infos["count"], ban_infos["window"]), status=403)
-        ban_response.headers["Retry-After"] = ban_infos["retry"]
-        return ban_response
+        retry = str(ban_infos["retry"])
+        return self.response_class(self._ban_body_for(ban_infos["ip"], retry), status=403, headers=(("Retry-After", retry),))
 
     def _rate_limit_func(self, rate_limit_infos):
         """internal func for creating a http response when the client is being rate limited.
@@ -96,21 +232,230 @@ class GateKeeper:
         Returns:
             Response: ready to be served response with 429 http code and retry after header
         """
-        rate_limit_response = Response("ip {} rate limited for {}s (over {} requests in a {}s window)".format(
-            rate_limit_infos["ip"], rate_limit_infos["retry"], rate_limit_infos["count"], rate_limit_infos["window"]), status=429)
-        rate_limit_response.headers["Retry-After"] = rate_limit_infos["retry"]
-        return rate_limit_response
+        retry = str(rate_limit_infos["retry"])
+        body = self._rate_limit_body_for(rate_limit_infos["ip"], retry, rate_limit_infos["count"], rate_limit_infos["window"])
+        return self.response_class(body, status=429, headers=(("Retry-After", retry),))
+
+    def _deny_func(self, ip):
+        """internal func for creating a http response when the client is in the denylist"""
+        return self.response_class(self._deny_body % ip if self.detailed_responses else "", status=403)
+
+    def _ban_body_for(self, ip, retry: str) -> str:
+        """body of the response to a banned client"""
+        return self._ban_body % (ip, retry) if self.detailed_responses else ""
+
+    def _rate_limit_body_for(self, ip, retry: str, count, window) -> str:
+        """body of the response to a rate limited client"""
+        if not self.detailed_responses:
+            return ""
+        template = self._rate_limit_bodies.get((count, window))
+        if template is None:
+            template = self._rate_limit_bodies[(count, window)] = "ip %s rate limited for %ss (over {} requests in a {}s window)".format(count, window)
+        return template % (ip, retry)
 
     def _get_ip(self) -> str:
         """Returns the IP of the client"""
+        request = self._request
         if self.ip_header:
             return request.headers.get(self.ip_header,request.remote_addr)
         return request.remote_addr
 
-    def _create(self, ip):
-        """add the IP to the tracked dict"""
-        if ip not in self.ips:
-            self.ips[ip] = IP(ban_count=self.ban_count, rate_count=self.rate_count)
+    def _is_guarded(self, request) -> bool:
+        """whether the global rules apply to this request, looked up in the policy table"""
+        policy = self._policies.get((request.endpoint, request.method))
+        if policy is None:
+            policy = request.method not in self.excluded_methods and request.endpoint not in self.bypass_routes
+            # only routed requests are cached, so that unknown paths or methods can't grow the table.
+            # routes can't be added once the app has handled its first request, so an entry never goes stale
+            url_rule = request.url_rule
+            if url_rule is not None and request.method in url_rule.methods:
+                self._policies[(request.endpoint, request.method)] = policy
+        return policy
+
+    def set_allowlist(self, cidrs: list = None):
+        """Replaces the allowlist. Requests being checked keep using the previous one, no lock is involved."""
+        self.allowlist = CIDRList(cidrs) if cidrs else None
+        self._update_access_lists()
+
+    def set_denylist(self, cidrs: list = None):
+        """Replaces the denylist. Requests being checked keep using the previous one, no lock is involved."""
+        self.denylist = CIDRList(cidrs) if cidrs else None
+        self._update_access_lists()
+
+    def _update_access_lists(self):
+        self._access_lists = self.allowlist is not None or self.denylist is not None or self.banned_networks is not None
+
+    def _access(self, ip):
+        """DENY or ALLOW if the IP is in the denylist (or a banned network) or the allowlist, otherwise None"""
+        denylist, allowlist, banned_networks = self.denylist, self.allowlist, self.banned_networks
+        if denylist is not None and ip in denylist:
+            return DENY
+        if banned_networks is not None and ip in banned_networks and self._network_banned(ip):
+            return DENY
+        if allowlist is not None and ip in allowlist:
+            return ALLOW
+        return None
+
+    def _network_banned(self, ip) -> bool:
+        """whether the banned network `ip` is in is still banned, dropping the ended bans"""
+        now = self.clock()
+        if now < self._network_bans_end:
+            return True
+        with self._admin_lock:
+            self._compile_network_bans(now)
+        banned_networks = self.banned_networks
+        return banned_networks is not None and ip in banned_networks
+
+    def _compile_network_bans(self, now):
+        network_bans = self._network_bans
+        for network in [network for network, until in network_bans.items() if until <= now]:
+            del network_bans[network]
+        self.banned_networks = CIDRList(network_bans) if network_bans else None
+        self._network_bans_end = min(network_bans.values(), default=float("inf"))
+        self._update_access_lists()
+
+    def ban(self, targets, duration: float):
+        """Bans addresses and networks for `duration` seconds, whatever their reports. Can be called outside of a request.
+
+        Addresses are banned in the storage, like by the ban rule, so the ban is shared by the processes sharing the storage.
+        Networks (e.g. "10.1.2.0/24") are banned by this instance only, their clients getting the response of the denylist until the ban ends.
+        A new ban replaces the previous one, even if it ends sooner.
+
+        Args:
+            targets (str or iterable): address or network, or many of them.
+            duration (float): seconds of ban.
+        """
+        now = self.clock()
+        addresses, networks = _split_targets(targets)
+        if addresses:
+            self.storage.set_bans(addresses, now + duration, now)
+            self.checks_bans = True
+        if networks:
+            with self._admin_lock:
+                self._network_bans.update((network, now + duration) for network in networks)
+                self._compile_network_bans(now)
+
+    def unban(self, targets):
+        """Lifts the bans of addresses and networks, the reports of the addresses being forgotten too. Can be called outside of a request.
+
+        Args:
+            targets (str or iterable): address or network, or many of them.
+        """
+        now = self.clock()
+        addresses, networks = _split_targets(targets)
+        if addresses:
+            self.storage.set_bans(addresses, None, now)
+        if networks:
+            with self._admin_lock:
+                for network in networks:
+                    self._network_bans.pop(network, None)
+                self._compile_network_bans(now)
+
+    def ban_statuses(self, ips) -> dict:
+        """Returns ip -> seconds of ban left (or None if not banned) for each of `ips`, whether banned by the ban rule, `.ban()` or a banned network.
+
+        The storage is queried in a single call (a single round trip for Redis).
+        """
+        ips = [ips] if isinstance(ips, str) else list(ips)
+        now = self.clock()
+        statuses = dict(zip(ips, self.storage.ban_statuses([str(ipaddress.ip_address(ip.strip())) for ip in ips], now)))
+        with self._admin_lock:
+            banned_networks, network_bans = self.banned_networks, list(self._network_bans.items())
+        if banned_networks is not None:
+            for ip in ips:
+                if ip in banned_networks:
+                    address = ipaddress.ip_address(ip)
+                    until = max((until for network, until in network_bans if address in ipaddress.ip_network(network)), default=0)
+                    if until > now:
+                        statuses[ip] = max(statuses[ip] or 0, until - now)
+        return statuses
+
+    def bans(self):
+        """Yields (address or network, seconds of ban left) for each ban in force, the banned networks first.
+
+        Raises NotImplementedError for the storages that don't keep the addresses of the clients (SharedMemoryStorage).
+        """
+        now = self.clock()
+        with self._admin_lock:
+            network_bans = list(self._network_bans.items())
+        for network, until in network_bans:
+            if until > now:
+                yield network, until - now
+        for ip, until in self.storage.bans(now):
+            yield ip, until - now
+
+    def _route_ip(self) -> str:
+        """IP of the client, as already read by the before request if it ran"""
+        return getattr(self._request, "_gatekeeper_ip", None) or self._get_ip()
+
+    def _decide(self, ip, now, timings: dict = None) -> tuple:
+        """Checks a request of `ip` against the access lists, then the bans, then the rate limiting rules (recording it if it is allowed).
+
+        This is the decision of every before request and of the middleware, which only time it, await it or turn it into a response.
+
+        Returns:
+            tuple: (decision, infos), the decision being "allowed", "allowlisted", "denied", "banned" or "rate_limited",
+                   and infos the ban or rate limit infos of a rejected request (None otherwise).
+                   With `timings`, the time spent in each phase is added to it (see `on_decision`).
+        """
+        if self._access_lists:
+            if timings is None:
+                access = self._access(ip)
+            else:
+                phase_start = perf_counter_ns()
+                access = self._access(ip)
+                timings["access"] = perf_counter_ns() - phase_start
+            if access is not None:
+                return ("denied", None) if access == DENY else ("allowlisted", None)
+
+        if self.checks_bans:
+            banned_for = self.storage.ban_status(ip, now) if timings is None else self.storage.ban_status_traced(ip, now, timings)
+            if banned_for is not None:
+                return "banned", self._ban_infos(ip, banned_for)
+
+        if self.checks_rates:
+            rate_limited = self._hit(ip, now) if timings is None else self._hit_traced(ip, now, timings)
+            if rate_limited:
+                if rate_limited[0] is None:  # banned, seen by a storage checking the bans along the rules
+                    return "banned", self._ban_infos(ip, rate_limited[2])
+                return "rate_limited", self._rate_limit_infos(ip, rate_limited)
+        return "allowed", None
+
+    async def _decide_async(self, ip, now, timings: dict = None) -> tuple:
+        """Same as _decide, awaiting the storage. Storages doing network calls are timed as a whole, per phase ("ban", "rate")."""
+        if self._access_lists:
+            access = self._access(ip)
+            if access is not None:
+                return ("denied", None) if access == DENY else ("allowlisted", None)
+
+        if self.checks_bans:
+            phase_start = perf_counter_ns()
+            banned_for = await self.storage.ban_status_async(ip, now)
+            if timings is not None:
+                timings["ban"] = perf_counter_ns() - phase_start
+            if banned_for is not None:
+                return "banned", self._ban_infos(ip, banned_for)
+
+        if self.checks_rates:
+            phase_start = perf_counter_ns()
+            rate_limited = await self._hit_async(ip, now)
+            if timings is not None:
+                timings["rate"] = perf_counter_ns() - phase_start
+            if rate_limited:
+                if rate_limited[0] is None:
+                    return "banned", self._ban_infos(ip, rate_limited[2])
+                return "rate_limited", self._rate_limit_infos(ip, rate_limited)
+        return "allowed", None
+
+    def _respond(self, ip, decision, infos):
+        """response to a rejected request, None to let it through"""
+        if decision == "banned":
+            return self._ban_func(infos)
+        if decision == "rate_limited":
+            return self._rate_limit_func(infos)
+        if decision == "denied":
+            return self._deny_func(ip)
+        return None
 
     def _before_request(self):
         """Function which runs before every request
@@ -118,59 +463,186 @@ class GateKeeper:
            if the client is either banned or rate-limited, we short-circuit the response 
            and reply directly with the appropriate message.
         """
-        if request.method not in self.excluded_methods and request.endpoint not in self.bypass_routes:
-            ip = self._get_ip()
-            self._create(ip)
-
-            if self.ban_rule:
-                is_banned = self._is_ip_banned(ip)
-                if is_banned:
-                    return self._ban_func(is_banned)
-
-            if self.rate_limit_rules:
-                is_rate_limited = self._is_ip_rate_limited(ip)
-                if is_rate_limited:
-                    return self._rate_limit_func(is_rate_limited)
-            self.ips[ip].add_entry()
-
-    def _is_ip_banned(self, ip) -> bool:
+        request = self._request
+        if self._is_guarded(request):
+            ip = request._gatekeeper_ip = self._get_ip() # reused by the route specific rules
+            decision, infos = self._decide(ip, self.clock())
+            return self._respond(ip, decision, infos)
+
+    async def _before_request_async(self):
+        """Same as _before_request, for async apps (e.g. Quart)"""
+        request = self._request
+        if self._is_guarded(request):
+            ip = request._gatekeeper_ip = self._get_ip() # reused by the route specific rules
+            decision, infos = await self._decide_async(ip, self.clock())
+            return self._respond(ip, decision, infos)
+
+    def _before_request_metered(self):
+        """Same as _before_request, counting the decisions in self.metrics"""
+        start = perf_counter_ns()
+        request = self._request
+        if self._is_guarded(request):
+            ip = request._gatekeeper_ip = self._get_ip()
+            decision, infos = self._decide(ip, self.clock())
+            response = self._respond(ip, decision, infos)
+            self.metrics.observe(request.endpoint, decision, _rule_label(infos) if decision == "rate_limited" else "", perf_counter_ns() - start)
+            return response
+
+    async def _before_request_metered_async(self):
+        """Same as _before_request_async, counting the decisions in self.metrics"""
+        start = perf_counter_ns()
+        request = self._request
+        if self._is_guarded(request):
+            ip = request._gatekeeper_ip = self._get_ip()
+            decision, infos = await self._decide_async(ip, self.clock())
+            response = self._respond(ip, decision, infos)
+            self.metrics.observe(request.endpoint, decision, _rule_label(infos) if decision == "rate_limited" else "", perf_counter_ns() - start)
+            return response
+
+    def _should_trace(self) -> bool:
+        """counts down to the next traced request (racy between threads, which is fine for sampling)"""
+        self._trace_countdown -= 1
+        if self._trace_countdown > 0:
+            return False
+        self._trace_countdown = self.trace_every
+        return True
+
+    def _decided(self, request, start, ip, decision, infos, timings):
+        """builds the response to a traced check, and reports it to the metrics and the on_decision hook"""
+        response_start = perf_counter_ns()
+        response = self._respond(ip, decision, infos)
+        if infos is not None:
+            timings["response"] = perf_counter_ns() - response_start
+        if self.metrics:
+            self.metrics.observe(request.endpoint, decision, _rule_label(infos) if decision == "rate_limited" else "", perf_counter_ns() - start)
+        if self.on_decision:
+            self.on_decision(request, decision, timings)
+        return response
+
+    def _before_request_traced(self):
+        """Same as _before_request, timing the phases of one request every `trace_every` for the hooks"""
+        request = self._request
+        if not self._is_guarded(request) or not self._should_trace():
+            return self._untraced()
+        if self.on_check_start:
+            self.on_check_start(request)
+
+        timings = {}
+        start = perf_counter_ns()
+        ip = request._gatekeeper_ip = self._get_ip()
+        now = self.clock()
+        timings["ip"] = perf_counter_ns() - start
+        decision, infos = self._decide(ip, now, timings)
+        return self._decided(request, start, ip, decision, infos, timings)
+
+    async def _before_request_traced_async(self):
+        """Same as _before_request_traced, for async apps (e.g. Quart)"""
+        request = self._request
+        if not self._is_guarded(request) or not self._should_trace():
+            return await self._untraced()
+        if self.on_check_start:
+            self.on_check_start(request)
+
+        timings = {}
+        start = perf_counter_ns()
+        ip = request._gatekeeper_ip = self._get_ip()
+        now = self.clock()
+        timings["ip"] = perf_counter_ns() - start
+        decision, infos = await self._decide_async(ip, now, timings)
+        return self._decided(request, start, ip, decision, infos, timings)
+
+    def _observe_route(self, endpoint, rate_limited, start):
+        """counts a request checked by the rules of a specific route, only its rejection if the global rules already counted it"""
+        request = self._request
+        checked = getattr(request, "_gatekeeper_ip", None) is None and not request.environ.get("gatekeeper.checked")
+        if rate_limited:
+            self.metrics.observe(endpoint, "rate_limited", _rule_label(rate_limited), perf_counter_ns() - start, checked=checked)
+        elif checked:
+            self.metrics.observe(endpoint, "allowed", "", perf_counter_ns() - start)
+
+    def _ban_infos(self, ip, banned_for):
+        if banned_for is not None:
+            ban_rule = self.ban_rule or {}
+            return {"ip": ip, "window": ban_rule.get("window"), "count": ban_rule.get("count"), "retry": int(banned_for)}
+        return None
+
+    def _rate_limit_infos(self, ip, rate_limited):
+        if rate_limited:
+            count, window, retry_in = rate_limited
+            return {"ip": ip, "window": window, "count": count, "retry": retry_in}
+        return None
+
+    def _is_ip_banned(self, ip, now: float = None) -> bool:
         """returns whether this IP is currently banned or not
         """
-        # have we too much counts for any of our rules -> ban
-        time_now = time.time()
-        if not self.ips[ip].ban_active_until:
-            if len([e for e in self.ips[ip].ban_entries if e >= time_now - self.ban_rule["window"]]) >= self.ban_rule["count"]:
-                banned_for = int((self.ips[ip].ban_entries[-1] + self.ban_rule["duration"]) - time_now)
-                self.ips[ip].ban_active_until = time_now + banned_for
-                return {"ip": ip, "window": self.ban_rule["window"], "count": self.ban_rule["count"], "retry": int(banned_for)}
-            return None
-
-        # is the ban duration over ? -> unban
-        if self.ips[ip].ban_active_until > time_now:
-            banned_for = self.ips[ip].ban_active_until - time_now
-            return {"ip": ip, "window": self.ban_rule["window"], "count": self.ban_rule["count"], "retry": int(banned_for)}
+        return self._ban_infos(ip, self.storage.ban_status(ip, self.clock() if now is None else now))
+
+    def _is_ip_rate_limited(self, ip, now: float = None) -> bool:
+        """returns whether this IP is currently rate limited or not, recording the request if it is not"""
+        return self._rate_limit_infos(ip, self._hit(ip, self.clock() if now is None else now))
+
+    def _hit(self, ip, now):
+        """checks the per IP then the subnet rules, returns (count, window, retry) of the first one the client is over"""
+        rate_limited = self.limiter.hit(ip, now) if self.algorithm else None
+        if self.subnets and not rate_limited:
+            return self.subnets.hit(ip, now)
+        return rate_limited
+
+    def _hit_traced(self, ip, now, timings):
+        """same as _hit, timing each rule"""
+        rate_limited = self.limiter.hit_traced(ip, now, timings) if self.algorithm else None
+        if self.subnets and not rate_limited:
+            subnets_start = perf_counter_ns()
+            rate_limited = self.subnets.hit(ip, now)
+            timings["subnets"] = perf_counter_ns() - subnets_start
+        return rate_limited
+
+    async def _hit_async(self, ip, now):
+        rate_limited = await self.limiter.hit_async(ip, now) if self.algorithm else None
+        if self.subnets and not rate_limited:
+            return await self.subnets.hit_async(ip, now)
+        return rate_limited
+
+    def init_app(self, app, middleware: bool = False):
+        """add our before request to the app now.
+
+        Async apps (whose request dispatching is a coroutine, like Quart) get an async before request,
+        so that the storage calls don't block the event loop.
+
+        With `middleware=True`, the global rules are instead enforced by a `GateKeeperMiddleware` wrapping `app.wsgi_app`,
+        which rejects banned or rate limited clients before flask builds the request context and routes the request.
+        Route specific rules are still enforced by their decorator. Only for WSGI apps.
+        """
+        if self.snapshot_path and self.snapshotter is None:
+            self._start_snapshots()
+        if self.journal_path and self.journal is None:
+            if os.path.exists(self.journal_path):
+                self.checks_bans = True  # the journal may hold bans set by `.ban()`
+            self.journal = self.storage.open_journal(self.journal_path, flush_interval=self.journal_interval).start()
+        if middleware:
+            from .middleware import GateKeeperMiddleware
+            if inspect.iscoroutinefunction(app.full_dispatch_request):
+                raise ValueError("the middleware mode is only available for WSGI apps")
+            app.wsgi_app = GateKeeperMiddleware(app, self)
+        elif inspect.iscoroutinefunction(app.full_dispatch_request):
+            from quart import request as quart_request
+            self._request = quart_request
+            self.response_class = app.response_class
+            self._untraced = self._before_request_metered_async if self.metrics else self._before_request_async
+            app.before_request(self._before_request_traced_async if self._traced() else self._untraced)
         else:
-            self.ips[ip].ban_active_until = 0
+            self._untraced = self._before_request_metered if self.metrics else self._before_request
+            app.before_request(self._before_request_traced if self._traced() else self._untraced)
 
-        return None
+    def _start_snapshots(self):
+        """loads the last snapshot if any, then saves one periodically and at exit"""
+        if os.path.exists(self.snapshot_path):
+            self.storage.load_snapshot(self.snapshot_path)
+            self.checks_bans = True  # the snapshot may hold bans set by `.ban()`
+        self.snapshotter = Snapshotter(self.storage, self.snapshot_path, self.snapshot_interval).start()
 
-    def _is_ip_rate_limited(self, ip) -> bool:
-        """returns whether this IP is currently rate limited or not"""
-        # in the last rate_interval, did we had more entries than rate_count ?
-        time_now = time.time()
-
-        for rule in self.rate_limit_rules:
-            rule_entries = [
-                e for e in self.ips[ip].rate_entries if e >= time_now - rule["window"]]
-            if len(rule_entries) >= rule["count"]:
-                retry_in = int(
-                    (rule_entries[0] + rule["window"]) - time_now) or 0
-                return {"ip": ip, "window": rule["window"], "count": rule["count"], "retry": retry_in}
-        return None
-
-    def init_app(self, app):
-        """add our before request to flask now"""
-        app.before_request(self._before_request)
+    def _traced(self) -> bool:
+        return self.on_check_start is not None or self.on_decision is not None
 
     def report(self, ip:str=None):
         """Report the client who made the request, increasing its tally towards being banned.
@@ -181,17 +653,19 @@ class GateKeeper:
             ip (str, optional): IP to ban. Defaults to None.
         """
         client_ip = ip or self._get_ip()
-        self.ips[client_ip].add_report()
+        self.storage.report(client_ip, self.clock())
+
+    async def report_async(self, ip:str=None):
+        """Same as report, for async routes. Use it with a storage doing network calls (e.g. RedisStorage with an asyncio client)."""
+        client_ip = ip or self._get_ip()
+        await self.storage.report_async(client_ip, self.clock())
 
     def bypass(self, route):
         """do not apply rate-limiting to this route"""
-        @wraps(route)
-        def wrapper(*a, **k):
-            return route(*a, **k)
-
         # We store the name of the function associated with the route, not the path of the route
+        # The route itself is left as is, so that async routes stay coroutines
         self.bypass_routes.add(route.__name__)
-        return wrapper
+        return route
 
     def specific(self, rate_limit_rules:list=[], standalone:bool=False):
         """Route specific gatekeeper. Only for rate limiting purposes.
@@ -202,24 +676,45 @@ class GateKeeper:
 
         You can supply a different ip_header, otherwise it will default to the instance configuration.
         """
-        specific_gk = GateKeeper(rate_limit_rules=rate_limit_rules,ip_header=self.ip_header)
-
         def decorator(route):
-            @wraps(route)
-            def wrapper(*args, **kwargs):
-
-                # We reproduce the same behavior as our _before_request func here
-                # but for the gk instance tied to this route
-                ip = specific_gk._get_ip()
-                specific_gk._create(ip)
-
-                if specific_gk.rate_limit_rules:
-                    rate_limited = specific_gk._is_ip_rate_limited(ip)
-                    if rate_limited:
-                        return self._rate_limit_func(rate_limited)
-
-                specific_gk.ips[ip].add_entry()
-                return route(*args, **kwargs)
+            # the rules of the route are resolved once here, the wrapper only has to hit their storage
+            algorithm = ALGORITHMS[self.algorithm_name](rate_limit_rules) if rate_limit_rules else None
+            storage = self.storage.spawn(route.__name__)
+            storage.bind(None, algorithm, self.clock)
+
+            if inspect.iscoroutinefunction(route):
+                @wraps(route)
+                async def wrapper(*args, **kwargs):
+                    ip = self._route_ip() if algorithm or self._access_lists else None
+                    access = self._access(ip) if self._access_lists else None
+                    if access == DENY:
+                        return self._deny_func(ip)
+                    if algorithm and access is None:
+                        start = perf_counter_ns()
+                        rate_limited = self._rate_limit_infos(ip, await storage.hit_async(ip, self.clock()))
+                        if self.metrics:
+                            self._observe_route(route.__name__, rate_limited, start)
+                        if rate_limited:
+                            return self._rate_limit_func(rate_limited)
+                    return await route(*args, **kwargs)
+            else:
+                @wraps(route)
+                def wrapper(*args, **kwargs):
+
+                    # We reproduce the same behavior as our _before_request func here
+                    # but with the rules tied to this route
+                    ip = self._route_ip() if algorithm or self._access_lists else None
+                    access = self._access(ip) if self._access_lists else None
+                    if access == DENY:
+                        return self._deny_func(ip)
+                    if algorithm and access is None:
+                        start = perf_counter_ns()
+                        rate_limited = self._rate_limit_infos(ip, storage.hit(ip, self.clock()))
+                        if self.metrics:
+                            self._observe_route(route.__name__, rate_limited, start)
+                        if rate_limited:
+                            return self._rate_limit_func(rate_limited)
+                    return route(*args, **kwargs)
 
             # remove ourselves from the global instance _before_request
             if standalone:
@@ -227,3 +722,20 @@ class GateKeeper:
             return wrapper
 
         return decorator
+
+
+def _rule_label(rate_limit_infos) -> str:
+    """label of the rule a client is over, e.g. 20/1s"""
+    return "{}/{}s".format(rate_limit_infos["count"], rate_limit_infos["window"])
+
+
+def _split_targets(targets) -> tuple:
+    """splits targets into normalized addresses and networks, e.g. "2001:DB8::1" -> "2001:db8::1". Raises ValueError for an invalid target."""
+    addresses, networks = [], []
+    for target in [targets] if isinstance(targets, str) else targets:
+        target = target.strip()
+        if "/" in target:
+            networks.append(str(ipaddress.ip_network(target, strict=False)))
+        else:
+            addresses.append(str(ipaddress.ip_address(target)))
+    return addresses, networks
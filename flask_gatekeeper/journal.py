@@ -0,0 +1,234 @@
+"""Append-only journal of the reports and bans of a MemoryStorage, to keep the bans across restarts and crashes.
+
+Each event is written as a 11 bytes header (kind, wall clock time, length of the ip) followed by the ip:
+- REPORT events are the reports of a client (see `GateKeeper.report()`), at the time of the report,
+- BAN events are the activations of a ban, at the time the ban ends,
+- UNBAN events are the bans lifted by `GateKeeper.unban()`, at the time of the unban.
+
+Events are queued by the request threads and written in batches by a background writer, so reporting a client does no I/O.
+A failed write (e.g. a full disk) keeps the events queued for the next one, and the queue is capped so that it can't grow forever.
+The journal is compacted (rewritten from the state of the storage) when it grows over `compact_bytes`, which bounds its replay.
+Replaying is idempotent, so the journal can be used on top of snapshots (see flask_gatekeeper.snapshots).
+"""
+import atexit
+import itertools
+import logging
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+REPORT = 1
+BAN = 2
+UNBAN = 3
+EVENT = struct.Struct("<BdH")
+# events of a client closer than this (in ms) are the same event, seen through clocks that drifted a bit
+SAME_EVENT_MS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, storage, path: str, flush_interval: float = 1.0, compact_bytes: int = 8 << 20, fsync: bool = True,
+                 max_pending: int = 100_000):
+        """Journal of the reports and bans of a MemoryStorage, usually created with `GateKeeper(journal_path=..)`.
+
+        Args:
+            storage (MemoryStorage): storage to journal, already bound.
+            path (str): journal file, created if needed.
+            flush_interval (float, optional): Seconds between two writes of the queued events. Defaults to 1.
+            compact_bytes (int, optional): Size of the journal over which it is compacted. Defaults to 8 MiB.
+            fsync (bool, optional): Sync the journal to the disk after each write. Defaults to True.
+            max_pending (int, optional): Events queued at most while the writes fail, the next ones are dropped. Defaults to 100000.
+        """
+        self.storage = storage
+        self.path = path
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self.max_pending = max_pending
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        self.compactions = 0
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._file = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def append(self, kind: int, ip: str, at: float):
+        """Queues an event, `at` being a time of the clock of the storage. Called by the storage."""
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append((kind, ip, at))
+
+    def start(self) -> "Journal":
+        """starts the writing thread, and the last write at exit"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="gatekeeper-journal", daemon=True)
+            self._thread.start()
+            atexit.register(self._try_flush)
+        return self
+
+    def stop(self):
+        """stops the writing thread, writing the queued events"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self._try_flush)
+        self.flush()
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self._try_flush()
+
+    def _try_flush(self):
+        """writes the queued events, logging a failure so that the writer keeps going"""
+        try:
+            self.flush()
+        except Exception:
+            self.failures += 1
+            logger.exception("could not write the journal %s", self.path)
+
+    @staticmethod
+    def _pack(kind, ip, at) -> bytes:
+        ip_bytes = ip.encode()
+        return EVENT.pack(kind, at, len(ip_bytes)) + ip_bytes
+
+    def flush(self) -> int:
+        """Writes the queued events, returns how many were written. Compacts the journal if it grew too large.
+
+        The events are only removed from the queue once written, a failed write raises and leaves them for the next one.
+        """
+        with self._lock:
+            pending = self._pending
+            count = len(pending)
+            if count:
+                shift = time.time() - self.storage.clock()
+                # the request threads only append, the first `count` events stay in place
+                data = b"".join(self._pack(kind, ip, at + shift) for kind, ip, at in list(itertools.islice(pending, count)))
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                end = self._file.tell()
+                try:
+                    self._file.write(data)
+                    self._file.flush()
+                    if self.fsync:
+                        os.fsync(self._file.fileno())
+                except OSError:
+                    self._discard(end)
+                    raise
+                for _ in range(count):
+                    pending.popleft()
+                self.written += count
+                if self._file.tell() > self.compact_bytes:
+                    self._compact()
+            return count
+
+    def _discard(self, end: int):
+        """drops a partly written batch, which would be written again after it"""
+        file, self._file = self._file, None
+        try:
+            file.truncate(end)
+        except OSError:
+            pass  # nothing more to do, the file is reopened by the next write
+        try:
+            file.close()
+        except OSError:
+            pass
+
+    def compact(self):
+        """Rewrites the journal from the state of the storage, keeping only the reports and bans that still matter."""
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        storage = self.storage
+        now = storage.clock()
+        shift = time.time() - now
+        shift_ms = shift * 1000
+        since_ms = (now - storage.ban_rule["window"]) * 1000 if storage.ban_rule else 0
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "wb") as f:
+            for ip, record in storage.ips.items():
+                with storage._lock_for(ip):
+                    events = [self._pack(REPORT, ip, (report + shift_ms) / 1000) for report in record.ban_entries or () if report >= since_ms]
+                    if record.ban_active_until > now:
+                        events.append(self._pack(BAN, ip, record.ban_active_until + shift))
+                if events:
+                    f.write(b"".join(events))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "ab")
+        self.compactions += 1
+
+    def replay(self) -> int:
+        """Applies the events of the journal to the storage, returns how many were applied.
+
+        Events older than the ttl of the clients are skipped, as is a partly written last event.
+        Reports not newer than the last known report of the client (e.g. restored from a snapshot) are not added twice.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        storage = self.storage
+        with open(self.path, "rb") as f:
+            data = f.read()
+        now = storage.clock()
+        shift = now - time.time()
+        ttl = storage.ips.ttl
+        applied, offset, end = 0, 0, len(data)
+        while offset + EVENT.size <= end:
+            kind, at, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            if offset + length > end:
+                break
+            ip = data[offset:offset + length].decode()
+            offset += length
+            at += shift
+            if kind == BAN:
+                if at <= now:
+                    continue
+                with storage._lock_for(ip):
+                    record = storage.ips.get_or_create(ip, storage._new_record, now)
+                    if abs(at - record.ban_active_until) * 1000 < SAME_EVENT_MS:
+                        continue
+                    record.ban_active_until = at
+            elif kind == UNBAN:
+                with storage._lock_for(ip):
+                    record = storage.ips.lookup(ip, now)
+                    if record is None or not (record.ban_active_until or record.ban_entries):
+                        continue
+                    record.ban_active_until = 0
+                    record.ban_entries = None
+            elif kind == REPORT and storage.ban_rule:
+                if ttl is not None and at < now - ttl:
+                    continue
+                at_ms = int(at * 1000)
+                with storage._lock_for(ip):
+                    record = storage.ips.get_or_create(ip, storage._new_record, now)
+                    # reports are kept sorted, the ones not newer than the last known report are already counted
+                    if record.ban_entries and at_ms <= record.ban_entries[-1] + SAME_EVENT_MS:
+                        continue
+                    record.add_report(at)
+            applied += 1
+        return applied
+
+    def stats(self) -> dict:
+        """Returns the number of events written, queued and dropped, the number of failed writes and of compactions"""
+        return {"written": self.written, "pending": len(self._pending), "dropped": self.dropped, "failures": self.failures,
+                "compactions": self.compactions}
@@ -0,0 +1,147 @@
+"""Counters and histograms of the decisions of a GateKeeper instance, in the Prometheus text format.
+"""
+import threading
+import weakref
+from bisect import bisect_left
+
+# upper bounds of the check duration histogram buckets, in ns
+DURATION_BUCKETS = (1_000, 2_500, 5_000, 10_000, 25_000, 50_000, 100_000, 250_000, 1_000_000, 2_500_000, 10_000_000)
+
+_HELP = {
+    "checked": "Requests checked against the rules",
+    "allowed": "Requests allowed",
+    "rate_limited": "Requests rejected by a rate limiting rule",
+    "banned": "Requests rejected because the client is banned",
+    "denied": "Requests rejected because the client is in the denylist",
+    "allowlisted": "Requests let through because the client is in the allowlist",
+}
+
+
+class _Shard:
+    """counters of a single thread"""
+    __slots__ = ("counters", "buckets", "duration_sum")
+
+    def __init__(self):
+        self.counters = {}  # (name, endpoint, rule) -> count
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.duration_sum = 0
+
+
+class Metrics:
+    def __init__(self, gatekeeper):
+        """Metrics of a GateKeeper instance, usually created with `GateKeeper(metrics=True)` and available as `gk.metrics`.
+
+        Counts the requests checked, allowed, rate limited (by rule) and banned, by endpoint, and the time spent checking them.
+        Each thread increments its own counters without locking, they are only merged when collected.
+        The number of tracked clients and of active bans are read from the storage when collected.
+
+        Requests checked by a `GateKeeperMiddleware` are counted under the endpoint "", as they are not routed yet.
+
+        Args:
+            gatekeeper (GateKeeper): instance whose decisions are counted.
+        """
+        self.gatekeeper = gatekeeper
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()  # counters of the threads that exited
+        self._lock = threading.Lock()
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+            # fold the counters of the thread once it is gone, so that short lived threads don't pile up shards
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+        return shard
+
+    def _retire(self, shard):
+        with self._lock:
+            self._shards.remove(shard)
+            _merge(self._retired, shard)
+
+    def observe(self, endpoint, decision: str, rule: str, duration_ns: int, checked: bool = True):
+        """Counts a checked request.
+
+        Args:
+            endpoint (str): endpoint of the request
+            decision (str): "allowed", "rate_limited", "banned", "denied" or "allowlisted"
+            rule (str): rule that rejected the request (e.g. "20/1s"), or "" if it was allowed or banned
+            duration_ns (int): time spent checking the request, in ns
+            checked (bool, optional): False to only count the decision of a request already counted
+                (e.g. rejected by the rules of its route after passing the global rules). Defaults to True.
+        """
+        shard = self._shard()
+        counters = shard.counters
+        key = (decision, endpoint, rule)
+        counters[key] = counters.get(key, 0) + 1
+        if checked:
+            key = ("checked", endpoint, "")
+            counters[key] = counters.get(key, 0) + 1
+            shard.buckets[bisect_left(DURATION_BUCKETS, duration_ns)] += 1
+            shard.duration_sum += duration_ns
+
+    def collect(self) -> dict:
+        """Returns the merged counters, and the gauges read from the storage.
+
+        Returns:
+            dict: {"counters": {(name, endpoint, rule): count}, "buckets": [count per DURATION_BUCKETS, then over],
+                   "duration_sum": ns, "tracked_clients": int, "active_bans": int or None}
+        """
+        total = _Shard()
+        with self._lock:
+            _merge(total, self._retired)
+            for shard in self._shards:
+                _merge(total, shard)
+        storage = self.gatekeeper.storage
+        return {"counters": total.counters, "buckets": total.buckets, "duration_sum": total.duration_sum,
+                "tracked_clients": storage.stats().get("size"), "active_bans": storage.active_bans(self.gatekeeper.clock())}
+
+    def render(self) -> str:
+        """Returns the metrics in the Prometheus text exposition format"""
+        collected = self.collect()
+        lines = []
+        for name, help_text in _HELP.items():
+            metric = "gatekeeper_requests_{}_total".format(name)
+            lines += ["# HELP {} {}".format(metric, help_text), "# TYPE {} counter".format(metric)]
+            for (counter, endpoint, rule), count in sorted(collected["counters"].items(), key=lambda item: (item[0][1] or "", item[0][2])):
+                if counter == name:
+                    labels = 'endpoint="{}"'.format(_escape(endpoint or ""))
+                    if rule:
+                        labels += ',rule="{}"'.format(rule)
+                    lines.append("{}{{{}}} {}".format(metric, labels, count))
+
+        for name, help_text in (("tracked_clients", "Clients tracked by the storage"), ("active_bans", "Clients currently banned")):
+            if collected[name] is not None:
+                lines += ["# HELP gatekeeper_{} {}".format(name, help_text), "# TYPE gatekeeper_{} gauge".format(name),
+                          "gatekeeper_{} {}".format(name, collected[name])]
+
+        metric = "gatekeeper_check_duration_seconds"
+        lines += ["# HELP {} Time spent checking a request".format(metric), "# TYPE {} histogram".format(metric)]
+        cumulative = 0
+        for bound, count in zip(DURATION_BUCKETS + (None,), collected["buckets"]):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(metric, "+Inf" if bound is None else bound / 1e9, cumulative))
+        lines += ["{}_sum {}".format(metric, collected["duration_sum"] / 1e9), "{}_count {}".format(metric, cumulative)]
+        return "\n".join(lines) + "\n"
+
+    def expose(self, app, path: str = "/metrics"):
+        """Adds a route serving `render()` to a flask app, bypassed by the gatekeeper"""
+        def gatekeeper_metrics():
+            return self.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+        self.gatekeeper.bypass(gatekeeper_metrics)
+        app.add_url_rule(path, "gatekeeper_metrics", gatekeeper_metrics)
+
+
+def _merge(into: _Shard, shard: _Shard):
+    # dict() copies the counters at once, while the thread of the shard might be adding some
+    for key, count in dict(shard.counters).items():
+        into.counters[key] = into.counters.get(key, 0) + count
+    for i, count in enumerate(list(shard.buckets)):
+        into.buckets[i] += count
+    into.duration_sum += shard.duration_sum
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
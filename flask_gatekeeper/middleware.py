@@ -0,0 +1,88 @@
+"""WSGI middleware enforcing the global rules of a GateKeeper instance before flask handles the request.
+"""
+from time import perf_counter_ns
+
+from flask import Flask
+
+
+class GateKeeperMiddleware:
+    def __init__(self, app: Flask, gatekeeper):
+        """Wraps `app.wsgi_app`, rejecting banned or rate limited clients from the WSGI environ directly.
+
+        Usually set up with `GateKeeper.init_app(app, middleware=True)`.
+
+        The client IP is read from REMOTE_ADDR, or from the `ip_header` of the GateKeeper instance.
+        Bypassed routes (see `GateKeeper.bypass`) are matched by path: the paths of the bypassed routes without
+        variable parts are collected from the url map on the first request, so matching them is a set lookup.
+        Only if a bypassed route has variable parts are the other requests routed by werkzeug to find their endpoint.
+        Decisions are counted by the metrics of the instance (under the endpoint ""), but never traced:
+        the `on_check_start` and `on_decision` hooks get a flask request, which doesn't exist yet.
+        The requests let through are marked with `environ["gatekeeper.checked"]`, so that the rules of
+        their route (see `GateKeeper.specific`) don't count them as checked again.
+
+        Args:
+            app (flask.Flask): Flask app whose wsgi_app to wrap.
+            gatekeeper (GateKeeper): GateKeeper instance whose rules to enforce.
+        """
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.gatekeeper = gatekeeper
+        self.ip_key = "HTTP_" + gatekeeper.ip_header.upper().replace("-", "_") if gatekeeper.ip_header else None
+        self._bypass_paths = None
+        self._bypass_needs_routing = False
+
+    def _build_bypass_map(self):
+        """collects the paths of the bypassed routes from the url map"""
+        paths = set()
+        for rule in self.app.url_map.iter_rules():
+            if rule.endpoint in self.gatekeeper.bypass_routes:
+                if rule.arguments:
+                    self._bypass_needs_routing = True
+                else:
+                    paths.add(rule.rule)
+        self._bypass_paths = frozenset(paths)
+
+    def _is_bypassed(self, environ) -> bool:
+        if self._bypass_paths is None:
+            self._build_bypass_map()
+        if (environ.get("PATH_INFO") or "/") in self._bypass_paths:
+            return True
+        if self._bypass_needs_routing:
+            try:
+                endpoint, _ = self.app.url_map.bind_to_environ(environ).match()
+            except Exception:  # not found, redirects.. flask will deal with it
+                return False
+            return endpoint in self.gatekeeper.bypass_routes
+        return False
+
+    def __call__(self, environ, start_response):
+        gatekeeper = self.gatekeeper
+        if environ.get("REQUEST_METHOD") not in gatekeeper.excluded_methods and not self._is_bypassed(environ):
+            start = perf_counter_ns()
+            ip = environ.get("REMOTE_ADDR")
+            if self.ip_key:
+                ip = environ.get(self.ip_key, ip)
+            decision, infos = gatekeeper._decide(ip, gatekeeper.clock())
+            if gatekeeper.metrics:
+                rule = "{}/{}s".format(infos["count"], infos["window"]) if decision == "rate_limited" else ""
+                gatekeeper.metrics.observe("", decision, rule, perf_counter_ns() - start)
+            if decision == "denied":
+                return self._reject(start_response, "403 FORBIDDEN", None, gatekeeper._deny_body % ip if gatekeeper.detailed_responses else "")
+            if decision == "banned":
+                retry = str(infos["retry"])
+                return self._reject(start_response, "403 FORBIDDEN", retry, gatekeeper._ban_body_for(ip, retry))
+            if decision == "rate_limited":
+                retry = str(infos["retry"])
+                return self._reject(start_response, "429 TOO MANY REQUESTS", retry, gatekeeper._rate_limit_body_for(ip, retry, infos["count"], infos["window"]))
+            environ["gatekeeper.checked"] = True
+
+        return self.wsgi_app(environ, start_response)
+
+    @staticmethod
+    def _reject(start_response, status, retry, body):
+        body = body.encode()
+        headers = [("Content-Type", "text/html; charset=utf-8"), ("Content-Length", str(len(body)))]
+        if retry is not None:
+            headers.append(("Retry-After", retry))
+        start_response(status, headers)
+        return [body]
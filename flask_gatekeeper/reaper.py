@@ -0,0 +1,77 @@
+"""Background reclaiming of the clients whose state can't matter anymore.
+"""
+import threading
+import time
+
+
+class Reaper:
+    def __init__(self, storage, interval: float = 10.0, slice_duration: float = 0.002, batch: int = 64):
+        """Sweeps a storage every `interval` seconds from a daemon thread, dropping the expired clients (see `Storage.reap()`).
+
+        Without it, expired clients are only dropped when a new client is added, so an idle app keeps them.
+        A sweep is done in slices: records are dropped `batch` at a time (each batch under the lock of the table),
+        and after `slice_duration` seconds of work the thread yields to the request threads before carrying on,
+        so that a sweep never holds the lock or the GIL for long.
+
+        Usually started with `GateKeeper(reap_interval=..)`.
+
+        Args:
+            storage (Storage): storage to sweep, already bound.
+            interval (float, optional): Seconds between the start of two sweeps. Defaults to 10.
+            slice_duration (float, optional): Seconds of work before yielding. Defaults to 2ms.
+            batch (int, optional): Records dropped per lock acquisition. Defaults to 64.
+        """
+        self.storage = storage
+        self.interval = interval
+        self.slice_duration = slice_duration
+        self.batch = batch
+        self.sweeps = 0
+        self.reclaimed = 0
+        self.last_reclaimed = 0
+        self.last_duration = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> "Reaper":
+        """starts the sweeping thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="gatekeeper-reaper", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """stops the sweeping thread, waiting for the current sweep to end"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sweep()
+
+    def sweep(self) -> int:
+        """Drops all the expired clients of the storage, returns how many were dropped."""
+        start = time.perf_counter()
+        slice_end = start + self.slice_duration
+        reclaimed = 0
+        while not self._stopped.is_set():
+            dropped = self.storage.reap(self.batch)
+            reclaimed += dropped
+            if dropped < self.batch:
+                break
+            if time.perf_counter() >= slice_end:
+                time.sleep(0)  # let the request threads run
+                slice_end = time.perf_counter() + self.slice_duration
+
+        self.sweeps += 1
+        self.reclaimed += reclaimed
+        self.last_reclaimed = reclaimed
+        self.last_duration = time.perf_counter() - start
+        return reclaimed
+
+    def stats(self) -> dict:
+        """Returns the number of sweeps, the records reclaimed in total and by the last sweep, and how long the last sweep took (in s)"""
+        return {"sweeps": self.sweeps, "reclaimed": self.reclaimed, "last_reclaimed": self.last_reclaimed,
+                "last_duration": self.last_duration}
@@ -0,0 +1,195 @@
+"""Count-min sketches of the requests of the clients, to estimate their rates in constant memory.
+
+- `CountMinSketch` counts the requests of each client over a rolling period,
+- `HeavyHitters` enforces rate limiting rules from such sketches, and keeps track of the clients making the most requests.
+"""
+import math
+import threading
+from array import array
+from time import perf_counter_ns
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 1 << 15, depth: int = 4, period: float = 60.0):
+        """Counts the requests of any number of clients over a rolling period, in a fixed amount of memory.
+
+        Counts are kept in `depth` rows of `width` counters, each client being counted in one counter of each row, chosen by hash.
+        The estimate of a client is its smallest counter: it is never below its true count, and with a probability of 1 - e^-depth
+        it is above it by at most e/width of all the requests counted (e.g. 0.008% with the default width).
+
+        The counters are kept for the current and the previous `period`, so the estimate of a client covers its requests
+        of the last `period` seconds at least, and of the last 2 * `period` seconds at most. Memory is 8 * width * depth bytes.
+
+        Client hashes are salted per process (see `hash()`), so that colliding clients can't be crafted.
+
+        Args:
+            width (int, optional): counters per row, rounded up to a power of 2. Defaults to 32768.
+            depth (int, optional): number of rows. Defaults to 4.
+            period (float, optional): seconds of requests counted by each generation of counters. Defaults to 60.
+        """
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.depth = depth
+        self.period = period
+        self.total = 0
+        self._mask = self.width - 1
+        self._current = array("I", bytes(4 * self.width * depth))
+        self._previous = array("I", bytes(4 * self.width * depth))
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def with_error(cls, error: float, confidence: float, period: float = 60.0) -> "CountMinSketch":
+        """Returns a sketch whose estimates are above the true counts by at most `error` times the requests counted, with a probability of `confidence`."""
+        if not 0 < error < 1 or not 0 < confidence < 1:
+            raise ValueError("error and confidence should be between 0 and 1, got {} and {}".format(error, confidence))
+        return cls(width=math.ceil(math.e / error), depth=math.ceil(math.log(1 / (1 - confidence))), period=period)
+
+    def indexes(self, key) -> list:
+        """Returns the counters of `key`, one per row"""
+        # double hashing: the rows use h1 + i * h2, from the two halves of the 64 bits hash
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        mask, width = self._mask, self.width
+        return [row * width + ((h1 + row * h2) & mask) for row in range(self.depth)]
+
+    def roll(self, now: float) -> bool:
+        """Moves the counters to the generation of `now`, returns whether it changed. Not thread safe, see `add()`."""
+        generation = int(now // self.period)
+        if generation == self.generation:
+            return False
+        if generation == self.generation + 1:
+            self._current, self._previous = self._previous, self._current
+        else:
+            self._previous = array("I", bytes(4 * self.width * self.depth))
+        self._current[:] = array("I", bytes(4 * self.width * self.depth))
+        self.generation = generation
+        self.total = 0
+        return True
+
+    def counts(self, indexes) -> tuple:
+        """Returns the estimated (current, previous) counts of the counters `indexes`. Not thread safe, see `add()`."""
+        current, previous = self._current, self._previous
+        return min(current[i] for i in indexes), min(previous[i] for i in indexes)
+
+    def increment(self, indexes):
+        """Counts a request on the counters `indexes`. Not thread safe, see `add()`."""
+        current = self._current
+        for i in indexes:
+            current[i] += 1
+        self.total += 1
+
+    def add(self, key, now: float) -> int:
+        """Counts a request of `key` made at `now`, returns its estimated count (this request included)."""
+        indexes = self.indexes(key)
+        with self._lock:
+            self.roll(now)
+            self.increment(indexes)
+            current, previous = self._current, self._previous
+            return min(current[i] + previous[i] for i in indexes)
+
+    def estimate(self, key, now: float) -> int:
+        """Returns the estimated count of `key`, without counting a request."""
+        indexes = self.indexes(key)
+        with self._lock:
+            self.roll(now)
+            current, previous = self._current, self._previous
+            return min(current[i] + previous[i] for i in indexes)
+
+
+class HeavyHitters:
+    def __init__(self, rules: list, error: float = 0.0005, confidence: float = 0.99, top: int = 100):
+        """Approximate rate limiting of the clients, in a memory that doesn't depend on their number (see `GateKeeper(approximate=True)`).
+
+        Each rule counts the requests in a `CountMinSketch` per window, and estimates the rolling count of a client like
+        the sliding window counter algorithm: its count in the current window, plus its count in the previous one weighted by
+        how much of the previous window is still in the rolling one. Estimates are never below the true counts,
+        so a client over a rule is always limited, and a client under it is wrongly limited only if the requests of the other clients
+        colliding with it reach the margin of the rule (at most `error` times the requests of the window, with a probability of `confidence`).
+
+        The `top` clients with the largest estimates over the largest window are tracked for operators, see `.top()`.
+
+        Args:
+            rules (list): rate limit rules [{"count":int,"window":int},..]
+            error (float, optional): Maximum overestimate of a count, as a fraction of the requests of its window. Defaults to 0.0005.
+            confidence (float, optional): Probability for an estimate to be within the error. Defaults to 0.99.
+            top (int, optional): Number of heavy hitters to track. Defaults to 100.
+        """
+        self.rules = [(r["count"], r["window"]) for r in rules]
+        self.max_window = max(window for _, window in self.rules)
+        self.sketches = [CountMinSketch.with_error(error, confidence, period=window) for _, window in self.rules]
+        self.error = error
+        self.confidence = confidence
+        self.top_size = top
+        # client -> estimated count over the largest window, for the `top_size` largest ones seen
+        self._heavy = {}
+        self._floor = 0
+        self._widest = max(range(len(self.rules)), key=lambda i: self.rules[i][1])
+        self._lock = threading.Lock()
+
+    def hit(self, ip: str, now: float) -> tuple:
+        """Returns (count, window, retry) if this IP is over a rule, otherwise counts the request and returns None."""
+        sketches = self.sketches
+        indexes = sketches[0].indexes(ip)  # all the sketches have the same shape
+        with self._lock:
+            for sketch in sketches:
+                if sketch.roll(now) and sketch is sketches[self._widest]:
+                    self._rescore(sketch)
+            for (count, window), sketch in zip(self.rules, sketches):
+                current, previous = sketch.counts(indexes)
+                elapsed = now - sketch.generation * window
+                if previous * (1 - elapsed / window) + current >= count:
+                    if current >= count:
+                        retry = (window - elapsed) + window * (1 - count / current)
+                    else:
+                        retry = window * (1 - (count - current) / previous) - elapsed
+                    return count, window, int(retry)
+            for sketch in sketches:
+                sketch.increment(indexes)
+            current, previous = sketches[self._widest].counts(indexes)
+            self._track(ip, current + previous)
+        return None
+
+    def hit_traced(self, ip: str, now: float, timings: dict) -> tuple:
+        start = perf_counter_ns()
+        rate_limited = self.hit(ip, now)
+        timings["rate"] = perf_counter_ns() - start
+        return rate_limited
+
+    async def hit_async(self, ip: str, now: float) -> tuple:
+        return self.hit(ip, now)
+
+    def _track(self, ip, estimate):
+        heavy = self._heavy
+        if ip in heavy:
+            heavy[ip] = estimate
+        elif len(heavy) < self.top_size:
+            heavy[ip] = estimate
+            self._floor = min(heavy.values())
+        elif estimate > self._floor:
+            del heavy[min(heavy, key=heavy.get)]
+            heavy[ip] = estimate
+            self._floor = min(heavy.values())
+
+    def _rescore(self, sketch):
+        """updates the tracked clients once the largest window moved, so that past heavy hitters make room for the new ones"""
+        heavy = self._heavy
+        for ip in list(heavy):
+            current, previous = sketch.counts(sketch.indexes(ip))
+            if current + previous:
+                heavy[ip] = current + previous
+            else:
+                del heavy[ip]
+        self._floor = min(heavy.values(), default=0)
+
+    def top(self, k: int = None) -> list:
+        """Returns the (ip, estimated count over the largest window) of the `k` (defaults to all the tracked) clients making the most requests."""
+        with self._lock:
+            ranked = sorted(self._heavy.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:k] if k is not None else ranked
+
+    def stats(self) -> dict:
+        """Returns the shape of the sketches, their memory and the maximum overestimate of a count in each rule (in requests, at the current rates)"""
+        sketch = self.sketches[0]
+        return {"width": sketch.width, "depth": sketch.depth, "bytes": 8 * sketch.width * sketch.depth * len(self.sketches),
+                "error_bounds": {"{}/{}s".format(count, window): math.ceil(sketch.total * math.e / sketch.width)
+                                 for (count, window), sketch in zip(self.rules, self.sketches)}}
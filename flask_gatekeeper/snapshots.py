@@ -0,0 +1,315 @@
+"""Snapshots of the state of a MemoryStorage, to keep the bans and counters across restarts.
+
+A snapshot is a binary file made of:
+- a 64 bytes header: magic, version, fingerprint of the rules, number of records, offset of the index, wall clock time of the save,
+  end of the longest ban saved,
+- the records, one after the other (see `_pack_record`),
+- the index: (64 bits hash of the ip, offset of the record) pairs, sorted by hash.
+
+Times are saved as wall clock times, so that a snapshot can be loaded by a process using another (e.g. monotonic) clock.
+The file is memory mapped when loaded, and records are only decoded when their client comes back, by a binary search in the index.
+"""
+import atexit
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+HEADER = struct.Struct("<8sIIQQQdd")
+HEADER_SIZE = 64
+MAGIC = b"gksnap\x00\x00"
+VERSION = 3
+INDEX_ENTRY = struct.Struct("<QQ")
+_COUNT = struct.Struct("<I")
+_TIMES = struct.Struct("<dd")
+
+logger = logging.getLogger(__name__)
+
+
+def _key(ip: str) -> int:
+    return int.from_bytes(hashlib.blake2b(ip.encode(), digest_size=8).digest(), "little")
+
+
+def fingerprint(storage) -> int:
+    """64 bits hash of the rules of a storage and of its scopes, rate states are only restored by storages with the same rules"""
+    algorithms = [storage.algorithm] + [scope.algorithm for scope in storage.scoped]
+    signature = repr([(algorithm.name, algorithm.rules) if algorithm else None for algorithm in algorithms])
+    return _key(signature)
+
+
+def _pack_values(values) -> bytes:
+    return struct.pack("<I{}d".format(len(values)), len(values), *values)
+
+
+def _pack_record(storage, ip, record, shift) -> bytes:
+    """ip, last seen, ban active until, reports (ms), global rate state, then the rate state of each scope"""
+    ip_bytes = ip.encode()
+    shift_ms = int(shift * 1000)
+    reports = [report + shift_ms for report in record.ban_entries] if record.ban_entries else []
+    parts = [_COUNT.pack(len(ip_bytes)), ip_bytes,
+             _TIMES.pack(record.last_seen + shift, record.ban_active_until + shift if record.ban_active_until else 0.0),
+             struct.pack("<I{}q".format(len(reports)), len(reports), *reports),
+             _pack_values(storage.algorithm.export_state(record.rate_state, shift) if storage.algorithm else [])]
+    scope_states = record.scope_states or []
+    parts.append(_COUNT.pack(len(scope_states)))
+    for scope, state in zip(storage.scoped, scope_states):
+        parts.append(_pack_values(scope.algorithm.export_state(state, shift) if state is not None and scope.algorithm else []))
+    return b"".join(parts)
+
+
+def write_snapshot(storage, path: str) -> int:
+    """Saves the live records of a MemoryStorage to `path`, returns the number of records saved.
+
+    The file is written next to `path` then renamed, so a crash never leaves a partial snapshot.
+    Each record is read under the lock of its client, the other clients are not blocked.
+    The live records of the snapshot loaded by the storage whose clients have not come back yet are carried over.
+    Banned clients are saved until their ban ends, even once idle for longer than the ttl.
+    """
+    now = storage.clock()
+    wall = time.time()
+    shift = wall - now
+    ttl = storage.ips.ttl
+    index = []
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as f:
+        f.write(bytes(HEADER_SIZE))
+        offset = HEADER_SIZE
+        saved = set()
+        bans_until = 0.0
+        for ip, record in storage.ips.items():
+            if ttl is not None and record.last_seen < now - ttl and record.ban_active_until <= now:
+                continue
+            with storage._lock_for(ip):
+                data = _pack_record(storage, ip, record, shift)
+                if record.ban_active_until > now:
+                    bans_until = max(bans_until, record.ban_active_until + shift)
+            f.write(data)
+            saved.add(ip)
+            index.append((_key(ip), offset))
+            offset += len(data)
+        loaded = storage.snapshot
+        if loaded is not None:
+            for ip, data, ban_until in loaded.unrestored(saved, wall - ttl if ttl is not None else None, wall):
+                if ban_until > wall:
+                    bans_until = max(bans_until, ban_until)
+                f.write(data)
+                index.append((_key(ip), offset))
+                offset += len(data)
+        index.sort()
+        f.write(b"".join(INDEX_ENTRY.pack(key, record_offset) for key, record_offset in index))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, 0, fingerprint(storage), len(index), offset, wall, bans_until))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+class Snapshot:
+    def __init__(self, storage, path: str):
+        """Snapshot loaded by a MemoryStorage (see `MemoryStorage.load_snapshot()`).
+
+        Only the header is read here, so loading is immediate whatever the size of the snapshot.
+        The records are restored one by one by `restore()`, when their client is first seen again.
+        Rate states are only restored if the rules are the same as when the snapshot was saved, bans and reports always are.
+
+        Args:
+            storage (MemoryStorage): bound storage the records are restored into.
+            path (str): snapshot file.
+        """
+        self.storage = storage
+        self.path = path
+        with open(path, "rb") as f:
+            self._file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.rules, self.records, index_offset, self.saved_at, bans_until = HEADER.unpack_from(self._file)
+        if magic != MAGIC or version != VERSION:
+            self._file.close()
+            raise ValueError("{} is not a flask-gatekeeper snapshot (version {})".format(path, VERSION))
+        # compared on the first restore, once the route specific rules are all declared
+        self.restores_rates = None
+        self.restored = 0
+        # clients restored, or whose state was set since (e.g. unbanned): their saved records are outdated
+        self._outdated = set()
+        self._index = memoryview(self._file)[index_offset:index_offset + self.records * INDEX_ENTRY.size].cast("Q")
+        # wall clock -> clock of the storage
+        self.shift = storage.clock() - time.time()
+        ttl = storage.ips.ttl
+        self.expires_at = max(self.saved_at + ttl, bans_until) + self.shift if ttl is not None else None
+
+    def close(self):
+        if self._file is not None:
+            self._index.release()
+            self._file.close()
+            self._file = None
+
+    def forget(self, ip: str):
+        """Marks the saved record of `ip` as outdated, so that it is neither restored nor carried over to the next snapshot."""
+        self._outdated.add(ip)
+
+    def _offsets(self, key):
+        """offsets of the records whose ip hashes to `key`"""
+        index, low, high = self._index, 0, self.records
+        while low < high:
+            middle = (low + high) // 2
+            if index[2 * middle] < key:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self.records and index[2 * low] == key:
+            yield index[2 * low + 1]
+            low += 1
+
+    def restore(self, ip: str):
+        """Returns the record of `ip` rebuilt from the snapshot, or None. Used as the loader of the client table.
+
+        A record is restored once: a client evicted after it came back must not get its saved state (e.g. a lifted ban) back.
+        """
+        if self._file is None or ip in self._outdated:
+            return None
+        if self.expires_at is not None and self.storage.clock() > self.expires_at:
+            # every record of the snapshot has expired by now
+            self.storage.ips.loader = None
+            return None
+        if self.restores_rates is None:
+            self.restores_rates = self.rules == fingerprint(self.storage)
+        for offset in self._offsets(_key(ip)):
+            ip_bytes, offset = self._read_bytes(offset)
+            if ip_bytes == ip.encode():
+                self.restored += 1
+                self._outdated.add(ip)
+                return self._unpack_record(offset)
+        return None
+
+    def unrestored(self, skipped, since, now):
+        """Yields (ip, saved record, end of its ban) for the records not in `skipped`, not outdated,
+        and seen after `since` or still banned at `now` (wall clock times).
+
+        The records are yielded as they were saved, without their rate limiting states if the rules changed.
+        """
+        if self._file is None:
+            return
+        if self.restores_rates is None:
+            self.restores_rates = self.rules == fingerprint(self.storage)
+        for i in range(self.records):
+            start = self._index[2 * i + 1]
+            ip_bytes, offset = self._read_bytes(start)
+            ip = ip_bytes.decode()
+            last_seen, ban_until = _TIMES.unpack_from(self._file, offset)
+            if ip in skipped or ip in self._outdated or (since is not None and last_seen < since and ban_until <= now):
+                continue
+            offset += _TIMES.size
+            _, offset = self._read_values(offset, "q")
+            if self.restores_rates:
+                _, offset = self._read_values(offset)
+                (scopes,) = _COUNT.unpack_from(self._file, offset)
+                offset += _COUNT.size
+                for _ in range(scopes):
+                    _, offset = self._read_values(offset)
+                yield ip, self._file[start:offset], ban_until
+            else:
+                yield ip, self._file[start:offset] + _pack_values([]) + _COUNT.pack(0), ban_until
+
+    def _read_bytes(self, offset):
+        (length,) = _COUNT.unpack_from(self._file, offset)
+        offset += _COUNT.size
+        return self._file[offset:offset + length], offset + length
+
+    def _read_values(self, offset, kind="d"):
+        (count,) = _COUNT.unpack_from(self._file, offset)
+        offset += _COUNT.size
+        values = struct.unpack_from("<{}{}".format(count, kind), self._file, offset)
+        return values, offset + count * 8
+
+    def _unpack_record(self, offset):
+        storage, shift = self.storage, self.shift
+        record = storage._new_record()
+        _, ban_active_until = _TIMES.unpack_from(self._file, offset)
+        offset += _TIMES.size
+        if ban_active_until:
+            record.ban_active_until = ban_active_until + shift
+        reports, offset = self._read_values(offset, "q")
+        if reports and record.ban_count:
+            shift_ms = int(shift * 1000)
+            for report in reports[-record.ban_count:]:
+                record.add_report((report + shift_ms) / 1000)
+        rate_state, offset = self._read_values(offset)
+        if self.restores_rates:
+            if rate_state and storage.algorithm:
+                record.rate_state = storage.algorithm.import_state(list(rate_state), shift)
+            (scopes,) = _COUNT.unpack_from(self._file, offset)
+            offset += _COUNT.size
+            if scopes:
+                record.scope_states = [None] * storage.scopes
+                for i in range(scopes):
+                    state, offset = self._read_values(offset)
+                    if state:
+                        record.scope_states[i] = storage.scoped[i].algorithm.import_state(list(state), shift)
+        return record
+
+
+class Snapshotter:
+    def __init__(self, storage, path: str, interval: float = 60.0):
+        """Saves a MemoryStorage to `path` every `interval` seconds from a daemon thread, and when the process exits.
+
+        Usually started with `GateKeeper(snapshot_path=..)`.
+
+        Args:
+            storage (MemoryStorage): storage to save, already bound.
+            path (str): snapshot file.
+            interval (float, optional): Seconds between two snapshots. Defaults to 60.
+        """
+        self.storage = storage
+        self.path = path
+        self.interval = interval
+        self.saves = 0
+        self.failures = 0
+        self.last_records = 0
+        self.last_duration = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self) -> "Snapshotter":
+        """starts the saving thread"""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="gatekeeper-snapshots", daemon=True)
+            self._thread.start()
+            atexit.register(self._try_save)
+        return self
+
+    def stop(self):
+        """stops the saving thread, waiting for the current save to end, and the save at exit"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+            atexit.unregister(self._try_save)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self._try_save()
+
+    def _try_save(self):
+        """saves a snapshot, logging a failure (e.g. a full disk) so that the next snapshots still happen"""
+        try:
+            self.save()
+        except Exception:
+            self.failures += 1
+            logger.exception("could not save the snapshot %s", self.path)
+
+    def save(self) -> int:
+        """Saves a snapshot now, returns the number of records saved."""
+        with self._lock:
+            start = time.perf_counter()
+            self.last_records = write_snapshot(self.storage, self.path)
+            self.last_duration = time.perf_counter() - start
+            self.saves += 1
+            return self.last_records
+
+    def stats(self) -> dict:
+        """Returns the number of snapshots saved and failed, the records in the last one and how long it took (in s)"""
+        return {"saves": self.saves, "failures": self.failures, "last_records": self.last_records, "last_duration": self.last_duration}
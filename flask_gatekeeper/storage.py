@@ -0,0 +1,934 @@
+"""Storage backends keeping the state of the clients of a GateKeeper instance.
+
+A storage is bound to a single GateKeeper instance (see `Storage.bind()`), and does the per-client operations atomically:
+- `ban_status(ip, now)` returns the remaining ban duration of the client, activating its ban if it has been reported enough,
+- `report(ip, now)` adds a report to the client,
+- `hit(ip, now)` checks the rate limiting rules, and records the request if it is allowed.
+
+Each operation has an async counterpart (`ban_status_async`..) used by async apps. By default they call the sync ones,
+which is fine for the storages that never block (memory, shared memory).
+
+The times given to the operations are read from the clock of the storage (see flask_gatekeeper.clocks), set by `bind()`.
+"""
+import hashlib
+import inspect
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from time import perf_counter_ns
+
+from . import clocks, journal, snapshots
+from .algorithms import GCRA, SlidingLog, SlidingWindowCounter, TimestampRing
+from .clients import ClientTable
+from .sketch import CountMinSketch
+
+try:
+    import fcntl
+except ImportError:  # not a posix system
+    fcntl = None
+
+# number of locks the clients are spread over, see Storage._lock_for
+LOCK_STRIPES = 64
+
+
+class IP:
+    __slots__ = ("ban_count", "ban_entries", "ban_active_until", "rate_state", "scope_states", "last_seen")
+
+    def __init__(self, ban_count, rate_state):
+        """IP record that keeps track of reports and requests made by that IP.
+
+        Slotted, as there is one per tracked client. The reports (a TimestampRing of ms) are only allocated when the client is first reported,
+        and the rate limiting states of the route specific rules (see `MemoryScope`) when the client first requests such a route.
+
+        Args:
+            ban_count (int): number of reports to keep
+            rate_state: rate limiting state of the client, as created by the rate limiting algorithm
+        """
+        self.ban_count = ban_count
+        self.ban_entries = None
+        self.ban_active_until = 0
+        self.rate_state = rate_state
+        self.scope_states = None
+        self.last_seen = 0
+
+    def add_report(self, now):
+        if not self.ban_count:  # no ban rule, reports can't ban anyone
+            return
+        if self.ban_entries is None:
+            self.ban_entries = TimestampRing(self.ban_count)
+        self.ban_entries.append(int(now * 1000))
+
+
+class Storage:
+    """Base class of the storage backends."""
+    # clock used when the GateKeeper instance doesn't set one
+    default_clock = staticmethod(clocks.monotonic)
+    # whether the state is shared with other processes, whose bans (see `GateKeeper.ban()`) must then always be checked
+    shared = False
+
+    def __init__(self):
+        self.ban_rule = None
+        self.algorithm = None
+        self.clock = self.default_clock
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+    def bind(self, ban_rule: dict, algorithm, clock=None):
+        """Called by the GateKeeper instance using this storage, with its rules and its clock.
+
+        Args:
+            ban_rule (dict): ban rule of the instance, or None
+            algorithm: rate limiting algorithm of the instance (see flask_gatekeeper.algorithms), or None
+            clock (callable, optional): clock the times given to the storage are read from. Defaults to `default_clock`.
+        """
+        self.ban_rule = ban_rule
+        self.algorithm = algorithm
+        self.clock = clock or self.default_clock
+
+    def spawn(self, scope: str) -> "Storage":
+        """Returns a new, unbound storage for the route specific rules of `scope`, which may keep its state along the state of this one."""
+        raise NotImplementedError
+
+    def _lock_for(self, ip) -> threading.Lock:
+        """Returns the lock guarding the state of this IP.
+
+        Clients are spread over LOCK_STRIPES locks by hash, so that requests from different clients
+        rarely wait on each other, while the check and record of a given client stay atomic.
+        """
+        return self._locks[hash(ip) % LOCK_STRIPES]
+
+    def ban_status(self, ip: str, now: float) -> float:
+        """Returns for how long (in s) this IP is banned, or None if it is not."""
+        raise NotImplementedError
+
+    def report(self, ip: str, now: float):
+        """Adds a report to this IP."""
+        raise NotImplementedError
+
+    def hit(self, ip: str, now: float) -> tuple:
+        """Returns (count, window, retry) if this IP is over a rate limiting rule, otherwise records the request and returns None.
+
+        A storage checking the bans along the rules (see `check_bans_on_hit()`) returns (None, None, banned for) for a banned IP.
+        """
+        raise NotImplementedError
+
+    def check_bans_on_hit(self) -> bool:
+        """Asks the storage to also check the bans set by `set_ban()` in `hit()`, returns whether it does.
+
+        Called by the GateKeeper instance when it has no ban rule, so that a storage doing network calls
+        checks the bans in the same round trip as the rate limiting rules.
+        """
+        return False
+
+    def stats(self) -> dict:
+        """Returns figures about the storage, such as the number of tracked clients."""
+        raise NotImplementedError
+
+    def ban_status_traced(self, ip: str, now: float, timings: dict) -> float:
+        """Same as ban_status, adding the ns spent in each phase to `timings` (see GateKeeper hooks)."""
+        start = perf_counter_ns()
+        banned_for = self.ban_status(ip, now)
+        timings["ban"] = perf_counter_ns() - start
+        return banned_for
+
+    def hit_traced(self, ip: str, now: float, timings: dict) -> tuple:
+        """Same as hit, adding the ns spent in each phase to `timings` (see GateKeeper hooks)."""
+        start = perf_counter_ns()
+        rate_limited = self.hit(ip, now)
+        timings["rate"] = perf_counter_ns() - start
+        return rate_limited
+
+    def active_bans(self, now: float) -> int:
+        """Returns the number of clients banned at `now`, or None if the storage can't count them cheaply."""
+        return None
+
+    def set_ban(self, ip: str, until: float, now: float):
+        """Bans this IP until `until` whatever its reports, or unbans it and forgets its reports if `until` is None."""
+        raise NotImplementedError
+
+    def set_bans(self, ips, until: float, now: float):
+        """Same as set_ban, for many IPs. Storages doing network calls send them in a single round trip."""
+        for ip in ips:
+            self.set_ban(ip, until, now)
+
+    def ban_statuses(self, ips, now: float) -> list:
+        """Same as ban_status, for many IPs."""
+        return [self.ban_status(ip, now) for ip in ips]
+
+    def bans(self, now: float):
+        """Yields the (ip, banned until) of the clients banned at `now`. Raises NotImplementedError if the storage doesn't keep the IPs."""
+        raise NotImplementedError
+
+    def reap(self, limit: int) -> int:
+        """Forgets up to `limit` clients whose state can't matter anymore, returns how many were forgotten.
+
+        Used by `Reaper`. Storages whose state expires by itself do nothing.
+        """
+        return 0
+
+    async def ban_status_async(self, ip: str, now: float) -> float:
+        return self.ban_status(ip, now)
+
+    async def report_async(self, ip: str, now: float):
+        return self.report(ip, now)
+
+    async def hit_async(self, ip: str, now: float) -> tuple:
+        return self.hit(ip, now)
+
+
+class MemoryStorage(Storage):
+    def __init__(self, max_clients: int = 100_000, client_ttl: float = None, client_table: ClientTable = None, fast_path: bool = False,
+                 sketch: CountMinSketch = None):
+        """Storage in the memory of the process (default).
+
+        Tracked clients are kept in a bounded `ClientTable`: at most `max_clients` records are kept (least recently used ones are evicted first),
+        and records idle for more than `client_ttl` seconds are dropped. By default `client_ttl` is the longest period a record can matter for,
+        i.e. the largest rate limit window or the ban window plus its duration.
+
+        Only reported and rate limited clients need a record: checking the ban of a client doesn't create one.
+        With `fast_path`, the requests of the clients without a record are first counted in a `CountMinSketch` over the largest window
+        of the rules, and a client only gets a record once its estimated count reaches half the smallest rule count.
+        Its counted requests are then recorded as made at that time, so it is never under-counted (it may be limited a bit early),
+        while the bulk of clients making a few requests never allocate any state.
+
+        Args:
+            max_clients (int, optional): Maximum number of clients to track. Defaults to 100 000.
+            client_ttl (float, optional): Seconds of inactivity after which a client is forgotten. Defaults to the largest window of the rules.
+            client_table (ClientTable, optional): Table to store the clients in, replaces max_clients and client_ttl. Defaults to None.
+            fast_path (bool, optional): Only create the records of the clients approaching a rule. Defaults to False.
+            sketch (CountMinSketch, optional): Sketch counting the clients without a record, implies fast_path. Defaults to a 1 MiB sketch.
+        """
+        super().__init__()
+        self.max_clients = max_clients
+        self.client_ttl = client_ttl
+        self.ips = client_table
+        self.scopes = 0
+        self.scoped = []
+        self.snapshot = None
+        self.journal = None
+        self.sketch = sketch
+        self.fast_path = fast_path or sketch is not None
+        self.promote_at = None
+        self._auto_ttl = client_table is None and client_ttl is None
+
+    def bind(self, ban_rule, algorithm, clock=None):
+        super().bind(ban_rule, algorithm, clock)
+        if self.ips is None:
+            windows = [algorithm.max_window] if algorithm else []
+            if ban_rule:
+                windows.append(ban_rule["window"] + ban_rule["duration"])
+            self.ips = ClientTable(max_size=self.max_clients, ttl=self.client_ttl or max(windows, default=0) or None,
+                                   clock=self.clock)
+        if self.ips.pinned is None:
+            # a ban set by `set_ban()` can outlast the ttl
+            self.ips.pinned = _banned
+        if self.fast_path and algorithm:
+            if self.sketch is None:
+                self.sketch = CountMinSketch(period=algorithm.max_window)
+            self.promote_at = max(1, min(rule[0] for rule in algorithm.rules) // 2)
+            # the fast path is chosen here, so that the storages without it don't pay for it
+            self.hit = self._hit_sketched
+            self.hit_traced = self._hit_sketched_traced
+
+    def spawn(self, scope):
+        # the route specific rules are kept in the records of this storage, so a client is tracked once whatever the routes it requests
+        self.scopes += 1
+        self.scoped.append(MemoryScope(self, self.scopes - 1))
+        return self.scoped[-1]
+
+    def _widen_ttl(self, window):
+        """makes the records live at least `window` seconds, unless the ttl was set by the user"""
+        if self._auto_ttl:
+            self.ips.ttl = max(self.ips.ttl or 0, window)
+
+    def _new_record(self):
+        """creates the record of a new client"""
+        return IP(ban_count=self.ban_rule["count"] if self.ban_rule else 0,
+                  rate_state=self.algorithm.new_state() if self.algorithm else None)
+
+    def ban_status(self, ip, now):
+        with self._lock_for(ip):
+            record = self.ips.lookup(ip, now)
+            return self._ban_status_of(ip, record, now) if record is not None else None
+
+    def _ban_status_of(self, ip, record, now):
+        if not record.ban_active_until:
+            # ban_entries holds at most `count` reports, so the rule is reached when it is full
+            # and its oldest report is still in the window
+            ban_entries = record.ban_entries
+            if ban_entries and len(ban_entries) >= self.ban_rule["count"] and ban_entries[0] >= (now - self.ban_rule["window"]) * 1000:
+                record.ban_active_until = ban_entries[-1] / 1000 + self.ban_rule["duration"]
+                if self.journal is not None:
+                    self.journal.append(journal.BAN, ip, record.ban_active_until)
+                return record.ban_active_until - now
+            return None
+
+        # is the ban duration over ? -> unban
+        if record.ban_active_until > now:
+            return record.ban_active_until - now
+        record.ban_active_until = 0
+        return None
+
+    def report(self, ip, now):
+        with self._lock_for(ip):
+            self.ips.get_or_create(ip, self._new_record, now).add_report(now)
+        if self.journal is not None:
+            self.journal.append(journal.REPORT, ip, now)
+
+    def hit(self, ip, now):
+        with self._lock_for(ip):
+            record = self.ips.get_or_create(ip, self._new_record, now)
+            rate_limited = self.algorithm.check(record.rate_state, now)
+            if not rate_limited:
+                self.algorithm.record(record.rate_state, now)
+            return rate_limited
+
+    def ban_status_traced(self, ip, now, timings):
+        with self._lock_for(ip):
+            start = perf_counter_ns()
+            record = self.ips.lookup(ip, now)
+            looked_up = perf_counter_ns()
+            banned_for = self._ban_status_of(ip, record, now) if record is not None else None
+            timings["lookup"] = timings.get("lookup", 0) + looked_up - start
+            timings["ban"] = perf_counter_ns() - looked_up
+            return banned_for
+
+    def hit_traced(self, ip, now, timings):
+        with self._lock_for(ip):
+            start = perf_counter_ns()
+            record = self.ips.get_or_create(ip, self._new_record, now)
+            timings["lookup"] = timings.get("lookup", 0) + perf_counter_ns() - start
+            rate_limited = self.algorithm.check_traced(record.rate_state, now, timings)
+            if not rate_limited:
+                start = perf_counter_ns()
+                self.algorithm.record(record.rate_state, now)
+                timings["record"] = perf_counter_ns() - start
+            return rate_limited
+
+    def _promoted(self, ip, now):
+        """record of a client without one whose request was counted by the sketch, or None if it is still far from the rules"""
+        count = self.sketch.add(ip, now)
+        if count < self.promote_at:
+            return None
+        record = self.ips.get_or_create(ip, self._new_record, now)
+        for _ in range(count - 1):  # the current request is recorded by the hit
+            self.algorithm.record(record.rate_state, now)
+        return record
+
+    def _hit_sketched(self, ip, now):
+        with self._lock_for(ip):
+            record = self.ips.lookup(ip, now) or self._promoted(ip, now)
+            if record is None:
+                return None
+            rate_limited = self.algorithm.check(record.rate_state, now)
+            if not rate_limited:
+                self.algorithm.record(record.rate_state, now)
+            return rate_limited
+
+    def _hit_sketched_traced(self, ip, now, timings):
+        with self._lock_for(ip):
+            start = perf_counter_ns()
+            record = self.ips.lookup(ip, now) or self._promoted(ip, now)
+            timings["lookup"] = timings.get("lookup", 0) + perf_counter_ns() - start
+            if record is None:
+                return None
+            rate_limited = self.algorithm.check_traced(record.rate_state, now, timings)
+            if not rate_limited:
+                start = perf_counter_ns()
+                self.algorithm.record(record.rate_state, now)
+                timings["record"] = perf_counter_ns() - start
+            return rate_limited
+
+    def stats(self):
+        return self.ips.stats()
+
+    def reap(self, limit):
+        return self.ips.expire(self.clock(), limit)
+
+    def active_bans(self, now):
+        return sum(1 for record in self.ips.values() if record.ban_active_until > now)
+
+    def set_ban(self, ip, until, now):
+        with self._lock_for(ip):
+            if until is None:
+                record = self.ips.lookup(ip, now)
+                if record is None:
+                    return
+                record.ban_active_until = 0
+                record.ban_entries = None
+            else:
+                self.ips.get_or_create(ip, self._new_record, now).ban_active_until = until
+            if self.snapshot is not None:
+                self.snapshot.forget(ip)
+        if self.journal is not None:
+            self.journal.append(journal.UNBAN if until is None else journal.BAN, ip, now if until is None else until)
+
+    def bans(self, now):
+        for ip, record in self.ips.items():
+            if record.ban_active_until > now:
+                yield ip, record.ban_active_until
+
+    def save_snapshot(self, path: str) -> int:
+        """Saves the state of the tracked clients to `path` (see flask_gatekeeper.snapshots), returns the number of clients saved."""
+        return snapshots.write_snapshot(self, path)
+
+    def load_snapshot(self, path: str) -> "snapshots.Snapshot":
+        """Restores the clients saved in `path` when they are first seen again, replacing any snapshot loaded before."""
+        if self.snapshot is not None:
+            self.snapshot.close()
+        self.snapshot = snapshots.Snapshot(self, path)
+        self.ips.loader = self.snapshot.restore
+        return self.snapshot
+
+    def open_journal(self, path: str, **kwargs) -> "journal.Journal":
+        """Replays the journal at `path` (see flask_gatekeeper.journal), then journals the reports and bans to it.
+
+        The writer is not started, call `.start()` on the returned journal. kwargs are passed to `Journal`.
+        """
+        events = journal.Journal(self, path, **kwargs)
+        events.replay()
+        self.journal = events
+        return events
+
+
+class MemoryScope(Storage):
+    def __init__(self, parent: MemoryStorage, index: int):
+        """Route specific rules of a MemoryStorage, created by `MemoryStorage.spawn()`.
+
+        The rate limiting state of the scope is kept in the `scope_states` of the records of the parent storage,
+        under the same lock, so there is a single record and lookup per client for the global and all the route specific rules.
+        Scopes only rate limit, they have no ban rule.
+
+        Args:
+            parent (MemoryStorage): storage holding the client records, already bound.
+            index (int): index of the state of this scope in `scope_states`.
+        """
+        super().__init__()
+        self.parent = parent
+        self.index = index
+
+    def bind(self, ban_rule, algorithm, clock=None):
+        super().bind(ban_rule, algorithm, clock)
+        if algorithm:
+            self.parent._widen_ttl(algorithm.max_window)
+
+    def spawn(self, scope):
+        return self.parent.spawn(scope)
+
+    def ban_status(self, ip, now):
+        return None
+
+    def report(self, ip, now):
+        pass
+
+    def hit(self, ip, now):
+        parent = self.parent
+        with parent._lock_for(ip):
+            record = parent.ips.get_or_create(ip, parent._new_record, now)
+            states = record.scope_states
+            if states is None:
+                states = record.scope_states = [None] * parent.scopes
+            elif len(states) <= self.index:
+                states.extend([None] * (parent.scopes - len(states)))
+            state = states[self.index]
+            if state is None:
+                state = states[self.index] = self.algorithm.new_state()
+            rate_limited = self.algorithm.check(state, now)
+            if not rate_limited:
+                self.algorithm.record(state, now)
+            return rate_limited
+
+    def stats(self):
+        return self.parent.stats()
+
+
+def _shm_path(name):
+    """shared memory files named without a directory go to /dev/shm if available, so they are never written to disk"""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+class SharedMemoryStorage(Storage):
+    # file header: magic, version, number of groups, slots per group, words per slot, fingerprint of the rules
+    HEADER = struct.Struct("<8sIIIIQ")
+    HEADER_SIZE = 64
+    MAGIC = b"gatekeep"
+    VERSION = 2
+    GROUP_SIZE = 8
+    shared = True
+
+    def __init__(self, path: str, slots: int = 65536, client_ttl: float = None):
+        """Storage in a memory mapped file, shared by all the processes of a host (e.g. gunicorn or uWSGI workers).
+
+        The file holds a fixed size hash table of per-client counters. Clients are spread by hash over groups of 8 slots,
+        and each group is guarded by a lock (a thread lock plus a fcntl lock on the file), so that
+        a check and record is atomic across all the workers. When a group is full, the least recently seen client of the group is evicted.
+
+        As the table is fixed size, only the constant memory rate limiting algorithms ("sliding-window-counter" and "gcra") are supported.
+        Every process must use the same rules: the rules are fingerprinted in the file, which must be removed when they change
+        (or when the host reboots, if it is not in /dev/shm, as the default clock is the monotonic clock of the host).
+        Only available on posix systems.
+
+        Args:
+            path (str): File to map, created if needed, which must be specific to the app (its processes share the state of the clients).
+                A name without a directory (e.g. "myapp-gatekeeper") is put in /dev/shm, or in the temp dir if /dev/shm doesn't exist.
+            slots (int, optional): Maximum number of clients to track, rounded up to a multiple of 8. Defaults to 65536.
+            client_ttl (float, optional): Seconds of inactivity after which a client slot can be reused. Defaults to the largest window of the rules.
+        """
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryStorage requires a posix system")
+        super().__init__()
+        self.path = path if os.path.dirname(path) else _shm_path(path)
+        self.groups = max(1, -(-slots // self.GROUP_SIZE))
+        self.slots = self.groups * self.GROUP_SIZE
+        self.client_ttl = client_ttl
+        self.evictions = 0
+        self._file = None
+
+    def bind(self, ban_rule, algorithm, clock=None):
+        if isinstance(algorithm, SlidingLog):
+            raise ValueError("SharedMemoryStorage needs a constant memory algorithm, use 'sliding-window-counter' or 'gcra'")
+        super().bind(ban_rule, algorithm, clock)
+        self.ban_count = ban_rule["count"] if ban_rule else 0
+        self.rate_words = len(algorithm.new_state()) if algorithm else 0
+        # slot: key, last seen, ban active until, number of reports, reports ring, rate state
+        self.rate_offset = 4 + self.ban_count
+        self.slot_words = self.rate_offset + self.rate_words
+
+        windows = [algorithm.max_window] if algorithm else []
+        if ban_rule:
+            windows.append(ban_rule["window"] + ban_rule["duration"])
+        self.ttl = self.client_ttl or max(windows, default=0) or float("inf")
+        rules = [(ban_rule["count"], ban_rule["window"], ban_rule["duration"]) if ban_rule else None,
+                 (algorithm.name, algorithm.rules) if algorithm else None]
+        self.fingerprint = self._key(repr(rules))
+        self._open()
+
+    def spawn(self, scope):
+        return SharedMemoryStorage(path="{}.{}".format(self.path, scope), slots=self.slots, client_ttl=self.client_ttl)
+
+    def _open(self):
+        """maps the file, creating and sizing it if we are the first process to use it"""
+        size = self.HEADER_SIZE + self.slots * self.slot_words * 8
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.groups, self.GROUP_SIZE, self.slot_words, self.fingerprint)
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX, self.HEADER_SIZE, 0)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+            elif os.pread(fd, self.HEADER.size, 0) != header:
+                raise ValueError("{} was created with a different layout or other rules, remove it or use another path".format(self.path))
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, self.HEADER_SIZE, 0)
+
+        self._fd = fd
+        self._file = mmap.mmap(fd, size)
+        words = memoryview(self._file)[self.HEADER_SIZE:]
+        self._keys = words.cast("Q")
+        self._values = words.cast("d")
+
+    def close(self):
+        """unmaps the file. The file itself is left for the other processes."""
+        if self._file is not None:
+            self._keys.release()
+            self._values.release()
+            self._file.close()
+            os.close(self._fd)
+            self._file = None
+
+    @staticmethod
+    def _key(ip) -> int:
+        """64 bits hash of the ip, stable across processes (0 is reserved for empty slots)"""
+        return int.from_bytes(hashlib.blake2b(ip.encode(), digest_size=8).digest(), "little") or 1
+
+    def _locked(self, key):
+        return _GroupLock(self, (key >> 32) % self.groups)
+
+    def _slot(self, key, group, now) -> int:
+        """Returns the offset (in words) of the slot of `key`, which must be in its group, claiming one if needed"""
+        keys, values = self._keys, self._values
+        first = group * self.GROUP_SIZE
+        victim, victim_seen = None, None
+        for slot in range(first, first + self.GROUP_SIZE):
+            offset = slot * self.slot_words
+            slot_key = keys[offset]
+            if slot_key == key:
+                values[offset + 1] = now
+                return offset
+            last_seen = values[offset + 1] if slot_key else float("-inf")
+            if victim is None or last_seen < victim_seen:
+                victim, victim_seen = offset, last_seen
+
+        # not tracked yet, take the least recently seen slot of the group
+        if victim_seen != float("-inf") and victim_seen >= now - self.ttl:
+            self.evictions += 1
+        values[victim:victim + self.slot_words] = _zeros(self.slot_words)
+        keys[victim] = key
+        values[victim + 1] = now
+        return victim
+
+    def ban_status(self, ip, now):
+        key = self._key(ip)
+        with self._locked(key) as group:
+            offset = self._slot(key, group, now)
+            values = self._values
+            ban_active_until = values[offset + 2]
+            if not ban_active_until:
+                reports = int(values[offset + 3])
+                count = self.ban_count
+                if count and reports >= count:
+                    ring = offset + 4
+                    oldest, newest = values[ring + reports % count], values[ring + (reports - 1) % count]
+                    if oldest >= now - self.ban_rule["window"]:
+                        values[offset + 2] = newest + self.ban_rule["duration"]
+                        return values[offset + 2] - now
+                return None
+
+            if ban_active_until > now:
+                return ban_active_until - now
+            values[offset + 2] = 0
+            return None
+
+    def report(self, ip, now):
+        if not self.ban_count:
+            return
+        key = self._key(ip)
+        with self._locked(key) as group:
+            offset = self._slot(key, group, now)
+            values = self._values
+            reports = int(values[offset + 3])
+            values[offset + 4 + reports % self.ban_count] = now
+            values[offset + 3] = reports + 1
+
+    def hit(self, ip, now):
+        key = self._key(ip)
+        with self._locked(key) as group:
+            offset = self._slot(key, group, now)
+            state = self._values[offset + self.rate_offset:offset + self.slot_words]
+            try:
+                rate_limited = self.algorithm.check(state, now)
+                if not rate_limited:
+                    self.algorithm.record(state, now)
+            finally:
+                state.release()
+            return rate_limited
+
+    def stats(self):
+        now = self.clock()
+        keys, values = self._keys, self._values
+        size = sum(1 for offset in range(0, self.slots * self.slot_words, self.slot_words)
+                   if keys[offset] and values[offset + 1] >= now - self.ttl)
+        return {"size": size, "max_size": self.slots, "ttl": self.ttl, "evictions": self.evictions, "path": self.path}
+
+    def active_bans(self, now):
+        keys, values = self._keys, self._values
+        return sum(1 for offset in range(0, self.slots * self.slot_words, self.slot_words)
+                   if keys[offset] and values[offset + 2] > now)
+
+    def set_ban(self, ip, until, now):
+        key = self._key(ip)
+        with self._locked(key) as group:
+            if until is not None:
+                self._values[self._slot(key, group, now) + 2] = until
+                return
+            keys, values = self._keys, self._values
+            for slot in range(group * self.GROUP_SIZE, (group + 1) * self.GROUP_SIZE):
+                offset = slot * self.slot_words
+                if keys[offset] == key:
+                    values[offset + 2] = values[offset + 3] = 0
+                    return
+
+    def bans(self, now):
+        raise NotImplementedError("SharedMemoryStorage only keeps hashes of the IPs")
+
+
+class _GroupLock:
+    """Locks a group of slots of a SharedMemoryStorage, for the threads of this process and for the other processes"""
+    __slots__ = ("storage", "group", "thread_lock")
+
+    def __init__(self, storage, group):
+        self.storage = storage
+        self.group = group
+        self.thread_lock = storage._locks[group % LOCK_STRIPES]
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        fcntl.lockf(self.storage._fd, fcntl.LOCK_EX, 1, self.storage.HEADER_SIZE + self.group)
+        return self.group
+
+    def __exit__(self, *exc):
+        fcntl.lockf(self.storage._fd, fcntl.LOCK_UN, 1, self.storage.HEADER_SIZE + self.group)
+        self.thread_lock.release()
+
+
+def _zeros(words, _cache={}):
+    """bytes-like of `words` zeroed doubles, to reset a slot"""
+    if words not in _cache:
+        _cache[words] = memoryview(bytes(words * 8)).cast("d")
+    return _cache[words]
+
+
+# Lua scripts of the RedisStorage, so that a check and its record are done in a single round trip.
+# The rate limiting scripts take ARGV = [now, ttl in ms, unique member, count1, window1, count2, window2..]
+# and return false if the request is allowed (and recorded), otherwise {rule number, retry}.
+_REDIS_HIT_SCRIPTS = {
+    SlidingLog: """
+local now, rules = tonumber(ARGV[1]), (#ARGV - 3) / 2
+local max_count, max_window = 0, 0
+for i = 1, rules do
+    max_count = math.max(max_count, tonumber(ARGV[2 + 2 * i]))
+    max_window = math.max(max_window, tonumber(ARGV[3 + 2 * i]))
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. (now - max_window))
+for i = 1, rules do
+    local count, window = tonumber(ARGV[2 + 2 * i]), tonumber(ARGV[3 + 2 * i])
+    local nth = redis.call('ZREVRANGE', KEYS[1], count - 1, count - 1, 'WITHSCORES')[2]
+    if nth and tonumber(nth) >= now - window then
+        return {i, tostring(tonumber(nth) + window - now)}
+    end
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -(max_count + 1))
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return false
+""",
+    SlidingWindowCounter: """
+local now, rules = tonumber(ARGV[1]), (#ARGV - 3) / 2
+local state = {}
+for i = 1, rules do
+    local count, window = tonumber(ARGV[2 + 2 * i]), tonumber(ARGV[3 + 2 * i])
+    local bucket = math.floor(now / window)
+    local values = redis.call('HMGET', KEYS[1], 'b' .. i, 'c' .. i, 'p' .. i)
+    local b, c, p = tonumber(values[1]) or 0, tonumber(values[2]) or 0, tonumber(values[3]) or 0
+    if b ~= bucket then
+        if b == bucket - 1 then p = c else p = 0 end
+        b, c = bucket, 0
+    end
+    local elapsed = now - bucket * window
+    if p * (1 - elapsed / window) + c >= count then
+        if c >= count then
+            return {i, tostring((window - elapsed) + window * (1 - count / c))}
+        end
+        return {i, tostring(window * (1 - (count - c) / p) - elapsed)}
+    end
+    state[i] = {b, c, p}
+end
+for i = 1, rules do
+    redis.call('HSET', KEYS[1], 'b' .. i, state[i][1], 'c' .. i, state[i][2] + 1, 'p' .. i, state[i][3])
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return false
+""",
+    GCRA: """
+local now, rules = tonumber(ARGV[1]), (#ARGV - 3) / 2
+local tats = {}
+for i = 1, rules do
+    local count, window = tonumber(ARGV[2 + 2 * i]), tonumber(ARGV[3 + 2 * i])
+    local interval = window / count
+    local tat = tonumber(redis.call('HGET', KEYS[1], i)) or 0
+    if tat - now > window - interval then
+        return {i, tostring(tat - (window - interval) - now)}
+    end
+    tats[i] = math.max(tat, now) + interval
+end
+for i = 1, rules do
+    redis.call('HSET', KEYS[1], i, string.format('%.17g', tats[i]))
+end
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return false
+""",
+}
+
+# Prepended to the rate limiting scripts: with a second key (ban), a banned client gets {0, remaining ban duration}
+_REDIS_BAN_CHECK = """
+if #KEYS > 1 then
+    local ban_active_until = tonumber(redis.call('GET', KEYS[2]))
+    if ban_active_until and ban_active_until > tonumber(ARGV[1]) then
+        return {0, tostring(ban_active_until - tonumber(ARGV[1]))}
+    end
+end
+"""
+
+# KEYS = [ban, reports], ARGV = [now, count, window, duration], returns the remaining ban duration or false
+_REDIS_BAN_SCRIPT = """
+local now = tonumber(ARGV[1])
+local ban_active_until = tonumber(redis.call('GET', KEYS[1]))
+if ban_active_until then
+    if ban_active_until > now then
+        return tostring(ban_active_until - now)
+    end
+    return false
+end
+local count = tonumber(ARGV[2])
+if count > 0 and redis.call('LLEN', KEYS[2]) >= count and tonumber(redis.call('LINDEX', KEYS[2], count - 1)) >= now - tonumber(ARGV[3]) then
+    ban_active_until = tonumber(redis.call('LINDEX', KEYS[2], 0)) + tonumber(ARGV[4])
+    if ban_active_until > now then
+        redis.call('SET', KEYS[1], string.format('%.17g', ban_active_until), 'PX', math.ceil((ban_active_until - now) * 1000))
+        return tostring(ban_active_until - now)
+    end
+end
+return false
+"""
+
+
+class RedisStorage(Storage):
+    # timestamps are compared across hosts
+    default_clock = staticmethod(clocks.wall)
+    shared = True
+
+    def __init__(self, client, prefix: str = "gatekeeper"):
+        """Storage in a Redis server, shared by all the processes and hosts using it.
+
+        Each check and record is done by a Lua script, in a single round trip, so it is atomic even with many hosts.
+        Keys expire by themselves once they can't count towards any rule anymore.
+        As timestamps are compared across hosts, their clocks should be synchronized.
+
+        Works with any client compatible with redis-py (`redis.Redis`, `fakeredis.FakeRedis`..), see `RedisStorage.from_url()`.
+        With an asyncio client (`redis.asyncio.Redis`..), only the async operations can be used, which is what an async app does,
+        the admin operations (see `GateKeeper.ban()`) raising a TypeError.
+
+        Args:
+            client (redis.Redis): Redis client to use.
+            prefix (str, optional): Prefix of the keys of this storage. Defaults to "gatekeeper".
+        """
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "gatekeeper") -> "RedisStorage":
+        """Creates a storage from a redis url, e.g. redis://localhost:6379/0. Requires the `redis` package."""
+        import redis
+        return cls(redis.Redis.from_url(url), prefix=prefix)
+
+    def bind(self, ban_rule, algorithm, clock=None):
+        super().bind(ban_rule, algorithm, clock)
+        if algorithm:
+            self._hit_script = self.client.register_script(_REDIS_BAN_CHECK + _REDIS_HIT_SCRIPTS[type(algorithm)])
+            self._rule_args = [value for count, window, *_ in algorithm.rules for value in (count, window)]
+            self._rate_ttl = int(algorithm.max_window * 1000) + 1000
+        # bans can also be set by `set_ban()`, without a ban rule
+        self._ban_script = self.client.register_script(_REDIS_BAN_SCRIPT)
+        self._ban_args = [ban_rule["count"], ban_rule["window"], ban_rule["duration"]] if ban_rule else [0, 0, 0]
+        self._hit_ban_prefix = None
+
+    def check_bans_on_hit(self):
+        if self.algorithm is None:
+            return False
+        self._hit_ban_prefix = "{}:ban:".format(self.prefix)
+        return True
+
+    def spawn(self, scope):
+        return RedisStorage(self.client, prefix="{}:{}".format(self.prefix, scope))
+
+    def _ban_call(self, ip, now):
+        return self._ban_script(keys=["{}:ban:{}".format(self.prefix, ip), "{}:reports:{}".format(self.prefix, ip)],
+                                args=[repr(now)] + self._ban_args)
+
+    def _report_call(self, ip, now):
+        key = "{}:reports:{}".format(self.prefix, ip)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.lpush(key, repr(now))
+        pipe.ltrim(key, 0, self.ban_rule["count"] - 1)
+        pipe.pexpire(key, int(self.ban_rule["window"] * 1000) + 1000)
+        return pipe.execute()
+
+    def _hit_call(self, ip, now):
+        keys = ["{}:rate:{}".format(self.prefix, ip)]
+        if self._hit_ban_prefix is not None:
+            keys.append(self._hit_ban_prefix + ip)
+        return self._hit_script(keys=keys,
+                                args=[repr(now), self._rate_ttl, os.urandom(8).hex()] + self._rule_args)
+
+    def _hit_result(self, rate_limited):
+        if rate_limited:
+            rule = int(rate_limited[0])
+            if rule == 0:  # banned, see check_bans_on_hit()
+                return None, None, float(rate_limited[1])
+            count, window, *_ = self.algorithm.rules[rule - 1]
+            return count, window, int(float(rate_limited[1]))
+        return None
+
+    def ban_status(self, ip, now):
+        banned_for = self._ban_call(ip, now)
+        return float(banned_for) if banned_for else None
+
+    def report(self, ip, now):
+        if self.ban_rule:
+            self._report_call(ip, now)
+
+    def hit(self, ip, now):
+        return self._hit_result(self._hit_call(ip, now))
+
+    async def ban_status_async(self, ip, now):
+        banned_for = await _maybe_await(self._ban_call(ip, now))
+        return float(banned_for) if banned_for else None
+
+    async def report_async(self, ip, now):
+        if self.ban_rule:
+            await _maybe_await(self._report_call(ip, now))
+
+    async def hit_async(self, ip, now):
+        return self._hit_result(await _maybe_await(self._hit_call(ip, now)))
+
+    def _sync_only(self, operation):
+        """the admin operations are sync, an asyncio client would leave their commands unsent"""
+        if inspect.iscoroutinefunction(self.client.execute_command):
+            raise TypeError("RedisStorage.{}() needs a sync redis client, got {} (use a sync client for the admin operations)"
+                            .format(operation, type(self.client).__name__))
+
+    def set_bans(self, ips, until, now):
+        self._sync_only("set_bans")
+        pipe = self.client.pipeline(transaction=False)
+        for ip in ips:
+            if until is None:
+                pipe.delete("{}:ban:{}".format(self.prefix, ip), "{}:reports:{}".format(self.prefix, ip))
+            elif until > now:
+                pipe.set("{}:ban:{}".format(self.prefix, ip), repr(until), px=math.ceil((until - now) * 1000))
+        pipe.execute()
+
+    def set_ban(self, ip, until, now):
+        self.set_bans((ip,), until, now)
+
+    def ban_statuses(self, ips, now):
+        self._sync_only("ban_statuses")
+        pipe = self.client.pipeline(transaction=False)
+        for ip in ips:
+            self._ban_script(keys=["{}:ban:{}".format(self.prefix, ip), "{}:reports:{}".format(self.prefix, ip)],
+                             args=[repr(now)] + self._ban_args, client=pipe)
+        return [float(banned_for) if banned_for else None for banned_for in pipe.execute()]
+
+    def bans(self, now):
+        self._sync_only("bans")
+        start = len(self.prefix) + len(":ban:")
+        keys = []
+        for key in self.client.scan_iter(match="{}:ban:*".format(self.prefix), count=1000):
+            keys.append(key)
+            if len(keys) == 1000:
+                yield from self._bans_of(keys, start, now)
+                keys = []
+        yield from self._bans_of(keys, start, now)
+
+    def _bans_of(self, keys, start, now):
+        if keys:
+            for key, until in zip(keys, self.client.mget(keys)):
+                if until is not None and float(until) > now:
+                    yield (key.decode() if isinstance(key, bytes) else key)[start:], float(until)
+
+    def stats(self):
+        return {"prefix": self.prefix}
+
+
+async def _maybe_await(result):
+    """awaits the result of an asyncio client, passes the result of a sync one"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+def _banned(record, now):
+    return record.ban_active_until > now
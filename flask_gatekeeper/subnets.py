@@ -0,0 +1,77 @@
+"""Rate limiting rules applied to the subnets of the clients, on top of the per IP rules.
+"""
+import socket
+
+from .algorithms import ALGORITHMS
+
+_FAMILIES = ((socket.AF_INET, 4, "ipv4_prefix", 24), (socket.AF_INET6, 16, "ipv6_prefix", 64))
+
+
+def network_of(ip: str, ipv4_prefix: int, ipv6_prefix: int) -> str:
+    """Returns the network of `ip` with the prefix of its family (e.g. 10.1.2.0/24), or None if `ip` is not an IP address.
+
+    Parsed and formatted by the socket module, which is much cheaper than building ipaddress objects.
+    """
+    if not ip or not isinstance(ip, str):  # e.g. no REMOTE_ADDR
+        return None
+    family, prefix = (socket.AF_INET6, ipv6_prefix) if ":" in ip else (socket.AF_INET, ipv4_prefix)
+    try:
+        packed = socket.inet_pton(family, ip)
+    except (OSError, ValueError):
+        return None
+    mask = ((1 << prefix) - 1) << (len(packed) * 8 - prefix)
+    network = (int.from_bytes(packed, "big") & mask).to_bytes(len(packed), "big")
+    return "{}/{}".format(socket.inet_ntop(family, network), prefix)
+
+
+class SubnetLimiter:
+    def __init__(self, rules: list, storage, algorithm: str, clock):
+        """Rate limits the subnets of the clients, so that rotating addresses within a /24 or a /64 doesn't get around the limits.
+
+        rules should be a list [{"count":int,"window":int,"ipv4_prefix":int,"ipv6_prefix":int},..] where
+        - count is the maximum number of requests from the whole subnet
+        - window is the rolling time window for the rate count
+        - ipv4_prefix and ipv6_prefix are the prefix lengths of the subnets (24 and 64 by default).
+
+        Rules with the same prefixes are checked together. Each subnet is tracked by the storage like a client,
+        keyed by its network (e.g. 10.1.2.0/24), in a scope of its own (see `Storage.spawn()`).
+
+        Args:
+            rules (list): subnet rules.
+            storage (Storage): storage of the GateKeeper instance, to spawn the scopes from.
+            algorithm (str): rate limiting algorithm of the rules.
+            clock (callable): clock of the GateKeeper instance.
+        """
+        levels = {}
+        for rule in rules:
+            prefixes = tuple(rule.get(key, default) for _, _, key, default in _FAMILIES)
+            for (_, size, key, _), prefix in zip(_FAMILIES, prefixes):
+                if not 0 < prefix <= size * 8:
+                    raise ValueError("{} should be between 1 and {}, got {}".format(key, size * 8, prefix))
+            levels.setdefault(prefixes, []).append({"count": rule["count"], "window": rule["window"]})
+
+        # (ipv4 prefix, ipv6 prefix, storage of the subnets)
+        self.levels = []
+        for (ipv4_prefix, ipv6_prefix), level_rules in levels.items():
+            scope = storage.spawn("subnet-{}-{}".format(ipv4_prefix, ipv6_prefix))
+            scope.bind(None, ALGORITHMS[algorithm](level_rules), clock)
+            self.levels.append((ipv4_prefix, ipv6_prefix, scope))
+
+    def hit(self, ip: str, now: float) -> tuple:
+        """Returns (count, window, retry) if a subnet of this IP is over a rule, otherwise records the request and returns None."""
+        for ipv4_prefix, ipv6_prefix, scope in self.levels:
+            network = network_of(ip, ipv4_prefix, ipv6_prefix)
+            if network is not None:
+                rate_limited = scope.hit(network, now)
+                if rate_limited:
+                    return rate_limited
+        return None
+
+    async def hit_async(self, ip: str, now: float) -> tuple:
+        for ipv4_prefix, ipv6_prefix, scope in self.levels:
+            network = network_of(ip, ipv4_prefix, ipv6_prefix)
+            if network is not None:
+                rate_limited = await scope.hit_async(network, now)
+                if rate_limited:
+                    return rate_limited
+        return None
@@ -0,0 +1,94 @@
+# tests for the rate limiting algorithms
+import pytest
+
+from .algorithms import GCRA, SlidingLog, SlidingWindowCounter, TimestampRing
+from .sketch import HeavyHitters
+
+RULES = [{"count": 20, "window": 1}, {"count": 100, "window": 10}]
+
+
+def hit(algorithm, state, now, timings=None):
+    """record a request if allowed, returns whether it was allowed (checked with check_traced if timings are given)"""
+    if algorithm.check(state, now) if timings is None else algorithm.check_traced(state, now, timings):
+        return False
+    algorithm.record(state, now)
+    return True
+
+
+@pytest.mark.parametrize("algorithm_class", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_algorithm_burst(algorithm_class):
+    algorithm = algorithm_class(RULES)
+    state = algorithm.new_state()
+
+    for i in range(20):
+        assert hit(algorithm, state, 1000 + i / 1000) # a burst of 20 requests is allowed
+    count, window, retry = algorithm.check(state, 1000.02)
+    assert (count, window) == (20, 1) # but not the 21st, because of the 1s rule
+    assert 0 <= retry <= 1
+    assert hit(algorithm, state, 1012) # everything is forgotten after the largest window
+
+
+@pytest.mark.parametrize("algorithm_class", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_algorithm_sustained(algorithm_class):
+    algorithm = algorithm_class(RULES)
+    state = algorithm.new_state()
+
+    allowed = sum(hit(algorithm, state, 1000 + i / 100) for i in range(2000)) # 100 requests/s for 20s
+    assert 180 <= allowed <= 300 # ~ 100 requests per 10s, plus a burst of 100 for the token bucket
+
+
+@pytest.mark.parametrize("algorithm_class", [SlidingWindowCounter, GCRA])
+def test_algorithm_constant_state(algorithm_class):
+    algorithm = algorithm_class([{"count": 100000, "window": 3600}])
+    state = algorithm.new_state()
+    for i in range(1000):
+        hit(algorithm, state, 1000 + i)
+    assert len(state) <= 3
+
+
+def test_timestamp_ring():
+    ring = TimestampRing(5)
+    for t in range(1, 8):
+        ring.append(t * 10)
+    assert list(ring) == [30, 40, 50, 60, 70] # only the last 5 are kept
+    assert len(ring.times) == 5 # grown up to the capacity only
+    assert (ring[0], ring[-1], ring[-5]) == (30, 70, 30)
+    assert ring.count_since(45) == 3 and ring.count_before(45) == 2
+    ring.drop_before(60)
+    assert list(ring) == [60, 70]
+    ring.append(80)
+    assert list(ring) == [60, 70, 80]
+
+
+@pytest.mark.parametrize("algorithm_class", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_algorithm_check_traced(algorithm_class):
+    algorithm, traced = algorithm_class(RULES), algorithm_class(RULES)
+    state, traced_state = algorithm.new_state(), traced.new_state()
+    for i in range(300): # the traced check takes the same decisions
+        now = 1000 + i / 100
+        timings = {}
+        assert hit(algorithm, state, now) == hit(traced, traced_state, now, timings)
+        assert set(timings) <= {"rule 20/1s", "rule 100/10s"} and "rule 20/1s" in timings
+
+
+def test_heavy_hitters():
+    heavy_hitters = HeavyHitters(RULES, error=0.001, top=3)
+    for i in range(20):
+        assert heavy_hitters.hit("10.6.0.1", 1000 + i / 1000) is None # a burst of 20 requests is allowed
+    count, window, retry = heavy_hitters.hit("10.6.0.1", 1000.02)
+    assert (count, window) == (20, 1) # but not the 21st, because of the 1s rule
+    assert 0 <= retry <= 1
+
+    # many clients making a few requests are not limited, the heaviest ones are listed
+    for i in range(20000):
+        assert heavy_hitters.hit("10.7.{}.{}".format(i // 256, i % 256), 1000.5) is None
+    for i in range(10):
+        assert heavy_hitters.hit("10.6.0.2", 1000.5) is None
+    assert [ip for ip, _ in heavy_hitters.top(2)] == ["10.6.0.1", "10.6.0.2"]
+    assert len(heavy_hitters.top()) == 3
+    assert heavy_hitters.top(1)[0][1] >= 20
+    stats = heavy_hitters.stats()
+    assert stats["bytes"] == 2 * 8 * stats["width"] * stats["depth"]
+    assert stats["error_bounds"]["20/1s"] < 20000 * 0.001 + 1
+
+    assert heavy_hitters.hit("10.6.0.1", 1012) is None # everything is forgotten after the largest window
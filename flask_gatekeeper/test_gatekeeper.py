@@ -1,21 +1,29 @@
 # tests for flask-gatekeeper
-from time import sleep
+import asyncio
+import socket
+from threading import Thread
 
 import pytest
 from flask import Flask
 
+from .access import CIDRList
+from .clients import ClientTable
+from .clocks import FakeClock
 from .gatekeeper import GateKeeper
+from .subnets import network_of
 
 @pytest.fixture()
 def flask_server_factory():
     def _flask_server():
-        """fixture 'factory' to create test flask servers for GateKeeper"""
+        """fixture 'factory' to create test flask servers for GateKeeper, along the fake clock they run on"""
         app = Flask(__name__)
+        clock = FakeClock()
         gk = GateKeeper(app, 
                         ip_header="x-my-ip",
                         ban_rule={"count":3,"window":10,"duration":10},
                         rate_limit_rules=[{"count":20,"window":1},{"count":100,"window":10}],
-                        excluded_methods=["HEAD"])
+                        excluded_methods=["HEAD"],
+                        clock=clock)
         
         @app.route("/ping")
         def ping():
@@ -41,12 +49,32 @@ def flask_server_factory():
         def bypass():
             return "ok", 200
 
-        return app.test_client()
+        return app.test_client(), clock
     return _flask_server
 
+@pytest.fixture()
+def gatekeeper_factory():
+    def _gatekeeper(middleware=False, **kwargs):
+        """fixture 'factory' to create test flask apps guarded by a GateKeeper built from kwargs, with a /ping and a /ban (reporting the client) route"""
+        app = Flask(__name__)
+        gk = GateKeeper(ip_header="x-my-ip", **kwargs)
+        gk.init_app(app, middleware=middleware)
+
+        @app.route("/ping")
+        def ping():
+            return "ok", 200
+
+        @app.route("/ban")
+        def ban():
+            gk.report()
+            return "ok", 200
+
+        return app, gk
+    return _gatekeeper
+
 
 def test_gatekeeper_ban(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
 
     ip1 = {"x-my-ip": "10.0.0.1"}
     ip2 = {"x-my-ip": "10.0.0.2"}
@@ -55,18 +83,18 @@ def test_gatekeeper_ban(flask_server_factory):
         assert flask_server.get("/ban",headers=ip1).status_code == 200 # 2 reports in a 10s window should not trigger a ban 
     assert flask_server.get("/ping",headers=ip1).status_code == 200 # ip1 not banned
 
-    sleep(10)
+    clock.advance(10.1) # the first reports are out of the window
     for _ in range(3):
         assert flask_server.get("/ban",headers=ip1).status_code == 200 # get reported
     assert flask_server.get("/ping",headers=ip1).status_code == 403 # ip1 is ban
     assert flask_server.get("/ping",headers=ip2).status_code == 200 # but only ip1
     assert "Retry-After" in flask_server.get("/ping",headers=ip1).headers # header is present
 
-    sleep(10)
+    clock.advance(10)
     assert flask_server.get("/ping",headers=ip1).status_code == 200 # ip1 unbanned
 
 def test_gatekeeper_rate_limit(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
     # {"count":20,"window":1},{"count":100,"window":10}])
     ip1 = {"x-my-ip": "10.0.1.1"}
     ip2 = {"x-my-ip": "10.0.1.2"}
@@ -75,19 +103,19 @@ def test_gatekeeper_rate_limit(flask_server_factory):
     for _ in range(20):
         assert flask_server.get("/ping").status_code == 200
     assert flask_server.get("/ping").status_code == 429
-    sleep(10)
+    clock.advance(10)
 
     for _ in range(10):
         for _ in range(10):
             assert flask_server.get("/ping").status_code == 200
-        sleep(.9)
+        clock.advance(.9)
     assert flask_server.get("/ping").status_code == 429
-    sleep(10)
+    clock.advance(10)
     assert flask_server.get("/ping").status_code == 200
 
 
 def test_gatekeeper_specific(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
     
     ip1 = {"x-my-ip": "10.0.2.1"}
     ip2 = {"x-my-ip": "10.0.2.2"}
@@ -96,11 +124,11 @@ def test_gatekeeper_specific(flask_server_factory):
     assert flask_server.get("/specific",headers=ip1).status_code == 200
     assert flask_server.get("/specific",headers=ip1).status_code == 429
     assert flask_server.get("/specific",headers=ip2).status_code == 200
-    sleep(2)
+    clock.advance(2.1)
     assert flask_server.get("/specific",headers=ip1).status_code == 200
 
 def test_gatekeeper_specific_standalone(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
     
     ip1 = {"x-my-ip": "10.0.3.1"}
     ip2 = {"x-my-ip": "10.0.3.2"}
@@ -110,12 +138,12 @@ def test_gatekeeper_specific_standalone(flask_server_factory):
         assert flask_server.get("/specific-standalone",headers=ip1).status_code == 200
     assert flask_server.get("/specific-standalone",headers=ip1).status_code == 429
     assert flask_server.get("/specific-standalone",headers=ip2).status_code == 200
-    sleep(5)
+    clock.advance(5.1)
     assert flask_server.get("/specific-standalone",headers=ip1).status_code == 200
 
 
 def test_gatekeeper_bypass(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
     
     ip1 = {"x-my-ip": "10.0.4.1"}
     for _ in range(30):
@@ -128,6 +156,340 @@ def test_gatekeeper_bypass(flask_server_factory):
     assert flask_server.get("/bypass",headers=ip1).status_code == 200 # but we can still access the bypass
 
 def test_gatekeeper_methods(flask_server_factory):
-    flask_server = flask_server_factory()
+    flask_server, clock = flask_server_factory()
     for _ in range(30):
         assert flask_server.head("/ping").status_code == 200 # we can burst the route
+
+def test_gatekeeper_report_without_ban_rule(gatekeeper_factory):
+    app, _ = gatekeeper_factory(rate_limit_rules=[{"count":10,"window":10}])
+    client = app.test_client()
+    assert [client.get("/ban").status_code for _ in range(3)] == [200, 200, 200] # reports are ignored
+
+class Record:
+    __slots__ = ("last_seen",)
+
+def test_client_table_eviction():
+    table = ClientTable(max_size=2)
+    table.get_or_create("10.0.5.1", Record)
+    table.get_or_create("10.0.5.2", Record)
+    table.get_or_create("10.0.5.1", Record) # 10.0.5.2 is now the least recently used
+    table.get_or_create("10.0.5.3", Record)
+
+    assert len(table) == 2
+    assert "10.0.5.2" not in table
+    assert "10.0.5.1" in table and "10.0.5.3" in table
+    assert table.stats()["evictions"] == 1
+
+def test_client_table_ttl():
+    clock = FakeClock()
+    table = ClientTable(ttl=1, clock=clock)
+    table.get_or_create("10.0.6.1", Record)
+    clock.advance(1.1)
+    table.get_or_create("10.0.6.2", Record) # expires the idle record
+
+    assert "10.0.6.1" not in table
+    assert len(table) == 1
+    assert table.stats()["expirations"] == 1
+
+def test_gatekeeper_algorithm(gatekeeper_factory):
+    app, _ = gatekeeper_factory(rate_limit_rules=[{"count":2,"window":10}], algorithm="gcra")
+    client = app.test_client()
+    assert [client.get("/ping").status_code for _ in range(3)] == [200, 200, 429]
+    with pytest.raises(ValueError):
+        GateKeeper(rate_limit_rules=[{"count":2,"window":10}], algorithm="leaky-bucket")
+
+def test_gatekeeper_approximate(gatekeeper_factory):
+    app, gk = gatekeeper_factory(ban_rule={"count":1,"window":10,"duration":10}, rate_limit_rules=[{"count":2,"window":10}],
+                                 approximate={"error":0.01,"top":10})
+    client = app.test_client()
+    assert [client.get("/ping").status_code for _ in range(3)] == [200, 200, 429]
+    assert gk.heavy_hitters.top() == [("127.0.0.1", 2)]
+    assert len(gk.storage.ips) == 0 # the storage only keeps the bans
+    client.get("/ban", environ_base={"REMOTE_ADDR": "10.0.0.9"})
+    assert client.get("/ping", environ_base={"REMOTE_ADDR": "10.0.0.9"}).status_code == 403
+
+def test_gatekeeper_threads(gatekeeper_factory):
+    app, _ = gatekeeper_factory(rate_limit_rules=[{"count":100,"window":60}])
+    statuses = []
+    def burst():
+        client = app.test_client()
+        statuses.extend(client.get("/ping").status_code for _ in range(50))
+
+    threads = [Thread(target=burst) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert statuses.count(200) == 100 # no request slipped past the limit
+
+def test_gatekeeper_async_views(gatekeeper_factory):
+    pytest.importorskip("asgiref") # needed by flask to run async views
+    app, gk = gatekeeper_factory(rate_limit_rules=[{"count":5,"window":60}])
+
+    @app.route("/specific")
+    @gk.specific(rate_limit_rules=[{"count":1,"window":60}])
+    async def specific():
+        return "ok", 200
+
+    @app.route("/bypass")
+    @gk.bypass
+    async def bypass():
+        return "ok", 200
+
+    client = app.test_client()
+    ip1 = {"x-my-ip": "10.0.7.1"}
+    assert client.get("/specific", headers=ip1).status_code == 200
+    assert client.get("/specific", headers=ip1).status_code == 429
+    assert client.get("/bypass", headers=ip1).status_code == 200
+
+def test_gatekeeper_quart():
+    quart = pytest.importorskip("quart")
+    app = quart.Quart(__name__)
+    gk = GateKeeper(app, ip_header="x-my-ip",
+                    ban_rule={"count":1,"window":60,"duration":60},
+                    rate_limit_rules=[{"count":3,"window":60}])
+
+    @app.route("/ping")
+    async def ping():
+        return "ok", 200
+
+    @app.route("/ban")
+    async def ban():
+        await gk.report_async()
+        return "ok", 200
+
+    @app.route("/specific")
+    @gk.specific(rate_limit_rules=[{"count":1,"window":60}], standalone=True)
+    async def specific():
+        return "ok", 200
+
+    async def scenario():
+        client = app.test_client()
+        ip1 = {"x-my-ip": "10.0.8.1"}
+        ip2 = {"x-my-ip": "10.0.8.2"}
+        statuses = [(await client.get("/ping", headers=ip1)).status_code for _ in range(4)]
+        assert statuses == [200, 200, 200, 429]
+        assert (await client.get("/specific", headers=ip2)).status_code == 200
+        assert (await client.get("/specific", headers=ip2)).status_code == 429
+        assert (await client.get("/ban", headers=ip2)).status_code == 200
+        assert (await client.get("/ping", headers=ip2)).status_code == 403
+
+    asyncio.run(scenario())
+
+@pytest.mark.parametrize("detailed", [True, False])
+def test_gatekeeper_responses(gatekeeper_factory, detailed):
+    app, _ = gatekeeper_factory(ban_rule={"count":1,"window":60,"duration":60}, rate_limit_rules=[{"count":1,"window":60}],
+                                detailed_responses=detailed)
+    client = app.test_client()
+    client.get("/ping", headers={"x-my-ip": "10.0.9.1"})
+    rate_limited = client.get("/ping", headers={"x-my-ip": "10.0.9.1"})
+    client.get("/ban", headers={"x-my-ip": "10.0.9.2"})
+    banned = client.get("/ping", headers={"x-my-ip": "10.0.9.2"})
+
+    assert (rate_limited.status_code, banned.status_code) == (429, 403)
+    assert rate_limited.headers["Retry-After"] == "59" and banned.headers["Retry-After"] == "59"
+    if detailed:
+        assert rate_limited.data == b"ip 10.0.9.1 rate limited for 59s (over 1 requests in a 60s window)"
+        assert banned.data == b"ip 10.0.9.2 banned for 59s (reported 1 times in a 60s window)"
+    else:
+        assert rate_limited.data == banned.data == b""
+
+def test_gatekeeper_middleware(gatekeeper_factory):
+    app, gk = gatekeeper_factory(middleware=True, ban_rule={"count":1,"window":60,"duration":60},
+                                 rate_limit_rules=[{"count":2,"window":60}], excluded_methods=["HEAD"])
+    seen = []
+
+    @app.before_request
+    def track():
+        seen.append(1) # only reached by the requests the middleware lets through
+
+    @app.route("/bypass/<name>")
+    @gk.bypass
+    def bypass(name):
+        return name, 200
+
+    client = app.test_client()
+    ip1 = {"x-my-ip": "10.0.10.1"}
+    ip2 = {"x-my-ip": "10.0.10.2"}
+    assert [client.get("/ping", headers=ip1).status_code for _ in range(3)] == [200, 200, 429]
+    assert len(seen) == 2
+    rate_limited = client.get("/ping", headers=ip1)
+    assert rate_limited.headers["Retry-After"] == "59" and b"rate limited" in rate_limited.data
+    assert client.get("/bypass/a", headers=ip1).status_code == 200 # bypassed through its dynamic path
+    assert client.head("/ping", headers=ip1).status_code == 200 # excluded method
+
+    assert client.get("/ban", headers=ip2).status_code == 200
+    assert client.get("/ping", headers=ip2).status_code == 403
+
+def test_gatekeeper_policies(gatekeeper_factory):
+    app, gk = gatekeeper_factory(rate_limit_rules=[{"count":100,"window":60}], excluded_methods=["HEAD"])
+
+    @app.route("/bypass")
+    @gk.bypass
+    def bypass():
+        return "ok", 200
+
+    client = app.test_client()
+    for _ in range(2):
+        client.get("/ping")
+        client.head("/ping")
+        client.get("/bypass")
+    client.get("/not-found")
+    client.open("/ping", method="BREW")
+    # resolved once per routed (endpoint, method), unknown paths and methods are not kept
+    assert gk._policies == {("ping", "GET"): True, ("ping", "HEAD"): False, ("bypass", "GET"): False}
+
+def test_gatekeeper_metrics(gatekeeper_factory):
+    app, gk = gatekeeper_factory(ban_rule={"count":1,"window":60,"duration":60}, rate_limit_rules=[{"count":2,"window":60}], metrics=True)
+    gk.metrics.expose(app)
+    client = app.test_client()
+    ip1 = {"x-my-ip": "10.0.11.1"}
+    ip2 = {"x-my-ip": "10.0.11.2"}
+    assert [client.get("/ping", headers=ip1).status_code for _ in range(3)] == [200, 200, 429]
+    client.get("/ban", headers=ip2)
+    assert client.get("/ping", headers=ip2).status_code == 403
+
+    counters = gk.metrics.collect()["counters"]
+    assert counters[("checked", "ping", "")] == 4
+    assert counters[("allowed", "ping", "")] == 2
+    assert counters[("rate_limited", "ping", "2/60s")] == 1
+    assert counters[("banned", "ping", "")] == 1
+
+    metrics = client.get("/metrics")
+    assert metrics.status_code == 200 and metrics.mimetype == "text/plain"
+    assert 'gatekeeper_requests_rate_limited_total{endpoint="ping",rule="2/60s"} 1' in metrics.text
+    assert "gatekeeper_active_bans 1" in metrics.text and "gatekeeper_tracked_clients 2" in metrics.text
+    assert "gatekeeper_check_duration_seconds_count 5" in metrics.text
+
+def test_gatekeeper_metrics_specific_routes(gatekeeper_factory):
+    app, gk = gatekeeper_factory(rate_limit_rules=[{"count":10,"window":60}], metrics=True)
+
+    @app.route("/shared")
+    @gk.specific(rate_limit_rules=[{"count":2,"window":60}])
+    def shared():
+        return "ok", 200
+
+    @app.route("/alone")
+    @gk.specific(rate_limit_rules=[{"count":2,"window":60}], standalone=True)
+    def alone():
+        return "ok", 200
+
+    client = app.test_client()
+    ip = {"x-my-ip": "10.0.11.3"}
+    assert [client.get("/shared", headers=ip).status_code for _ in range(3)] == [200, 200, 429]
+    assert [client.get("/alone", headers=ip).status_code for _ in range(3)] == [200, 200, 429]
+
+    # each request is counted once, by the global rules or by the rules of its route
+    counters = gk.metrics.collect()["counters"]
+    assert counters[("checked", "shared", "")] == counters[("checked", "alone", "")] == 3
+    assert counters[("rate_limited", "shared", "2/60s")] == counters[("rate_limited", "alone", "2/60s")] == 1
+    assert counters[("allowed", "alone", "")] == 2
+
+def test_gatekeeper_middleware_metrics_specific_routes(gatekeeper_factory):
+    app, gk = gatekeeper_factory(middleware=True, rate_limit_rules=[{"count":10,"window":60}], metrics=True)
+
+    @app.route("/shared")
+    @gk.specific(rate_limit_rules=[{"count":2,"window":60}])
+    def shared():
+        return "ok", 200
+
+    client = app.test_client()
+    assert [client.get("/shared", headers={"x-my-ip": "10.0.11.4"}).status_code for _ in range(3)] == [200, 200, 429]
+
+    # checked by the middleware, the route only counts the rejection
+    counters = gk.metrics.collect()["counters"]
+    assert counters[("checked", "", "")] == 3
+    assert ("checked", "shared", "") not in counters
+    assert counters[("rate_limited", "shared", "2/60s")] == 1
+
+def test_gatekeeper_hooks(gatekeeper_factory):
+    started, decisions = [], []
+    app, _ = gatekeeper_factory(ban_rule={"count":1,"window":60,"duration":60},
+                                rate_limit_rules=[{"count":20,"window":1},{"count":2,"window":60}],
+                                on_check_start=started.append, on_decision=lambda request, decision, timings: decisions.append((decision, timings)),
+                                trace_every=2)
+    client = app.test_client()
+    statuses = [client.get("/ping", headers={"x-my-ip": "10.0.12.1"}).status_code for _ in range(4)]
+    assert statuses == [200, 200, 429, 429] # tracing doesn't change the decisions
+    assert len(started) == 2 # 1 request out of 2 is traced
+    assert [decision for decision, _ in decisions] == ["allowed", "rate_limited"]
+    assert set(decisions[0][1]) == {"ip", "lookup", "ban", "rule 20/1s", "rule 2/60s", "record"}
+    assert set(decisions[1][1]) == {"ip", "lookup", "ban", "rule 20/1s", "rule 2/60s", "response"}
+    assert all(isinstance(ns, int) for _, timings in decisions for ns in timings.values())
+
+def test_gatekeeper_subnets(gatekeeper_factory):
+    assert network_of("10.1.2.3", 24, 64) == "10.1.2.0/24"
+    assert network_of("2001:db8:1:2:3:4:5:6", 24, 48) == "2001:db8:1::/48"
+    assert network_of("not an ip", 24, 64) is None
+    assert network_of(None, 24, 64) is None and network_of("", 24, 64) is None
+
+    app, _ = gatekeeper_factory(rate_limit_rules=[{"count":2,"window":60}],
+                                subnet_rules=[{"count":3,"window":60}, {"count":4,"window":60,"ipv4_prefix":16}])
+    client = app.test_client()
+    statuses = [client.get("/ping", headers={"x-my-ip": "10.0.13.{}".format(i)}).status_code for i in range(4)]
+    assert statuses == [200, 200, 200, 429] # rotating addresses within the /24
+    assert client.get("/ping", headers={"x-my-ip": "10.0.14.1"}).status_code == 200 # another /24 of the /16
+    assert client.get("/ping", headers={"x-my-ip": "10.0.15.1"}).status_code == 429 # but the /16 is full
+    statuses = [client.get("/ping", headers={"x-my-ip": "fd00::{}".format(i)}).status_code for i in range(4)]
+    assert statuses == [200, 200, 200, 429] # same for a /64
+    assert client.get("/ping", environ_base={"REMOTE_ADDR": None}).status_code == 200 # no address, no subnet
+
+    with pytest.raises(ValueError):
+        GateKeeper(subnet_rules=[{"count":3,"window":60,"ipv4_prefix":33}])
+
+def test_gatekeeper_access_lists(gatekeeper_factory):
+    cidrs = CIDRList(["10.1.0.0/16", "10.1.2.0/24", "10.3.0.0/16", "10.2.0.0/16", "192.168.1.1", "2001:db8::/32"])
+    assert cidrs._ranges[socket.AF_INET][0] == [0x0A010000, 0xC0A80101] # overlapping and adjacent networks are merged
+    assert "10.2.200.1" in cidrs and "192.168.1.1" in cidrs and "2001:db8:ffff::1" in cidrs
+    assert "10.4.0.1" not in cidrs and "192.168.1.2" not in cidrs and "2001:db9::1" not in cidrs and "garbage" not in cidrs
+    assert None not in cidrs and "" not in cidrs
+
+    app, gk = gatekeeper_factory(rate_limit_rules=[{"count":1,"window":60}], allowlist=["10.0.16.0/24"], denylist=["10.0.17.0/24"])
+    client = app.test_client()
+    allowed, denied = {"x-my-ip": "10.0.16.1"}, {"x-my-ip": "10.0.17.1"}
+    assert [client.get("/ping", headers=allowed).status_code for _ in range(3)] == [200, 200, 200]
+    assert client.get("/ping", headers=denied).status_code == 403
+    assert "10.0.16.1" not in gk.storage.ips and "10.0.17.1" not in gk.storage.ips # no state was created
+
+    gk.set_allowlist(None) # reloaded at runtime
+    gk.set_denylist(["10.0.16.0/24"])
+    assert client.get("/ping", headers=allowed).status_code == 403
+    assert [client.get("/ping", headers=denied).status_code for _ in range(2)] == [200, 429]
+    assert client.get("/ping", environ_base={"REMOTE_ADDR": None}).status_code == 200 # no address, not in the lists
+
+def test_gatekeeper_admin_bans(gatekeeper_factory):
+    clock = FakeClock()
+    app, gk = gatekeeper_factory(rate_limit_rules=[{"count":100,"window":10}], clock=clock)
+    client = app.test_client()
+    ping = lambda ip: client.get("/ping", headers={"x-my-ip": ip}).status_code
+
+    # without a ban rule, from outside of a request
+    gk.ban(["10.8.{}.{}".format(i // 256, i % 256) for i in range(1000)], 60)
+    gk.ban("10.9.0.0/16", 30)
+    assert ping("10.8.0.1") == 403
+    assert ping("10.9.3.4") == 403
+    assert ping("10.10.0.1") == 200
+    statuses = gk.ban_statuses(["10.8.0.1", "10.9.3.4", "10.10.0.1"])
+    assert statuses == {"10.8.0.1": 60, "10.9.3.4": 30, "10.10.0.1": None}
+    bans = dict(gk.bans())
+    assert len(bans) == 1001 and bans["10.9.0.0/16"] == 30
+
+    gk.unban(["10.8.0.1", "10.9.0.0/16"])
+    assert ping("10.8.0.1") == 200
+    assert ping("10.9.3.4") == 200
+    assert ping("10.8.0.2") == 403
+
+    # addresses are normalized, invalid targets are rejected
+    gk.ban("2001:DB8::1", 60)
+    assert ping("2001:db8::1") == 403
+    assert gk.ban_statuses("2001:DB8:0::1") == {"2001:DB8:0::1": 60}
+    with pytest.raises(ValueError):
+        gk.ban("garbage", 60)
+
+    clock.advance(61) # the bans end by themselves
+    gk.ban("10.11.0.0/16", 10)
+    assert ping("10.8.0.2") == 200
+    assert len(list(gk.bans())) == 1
+    clock.advance(11)
+    assert ping("10.11.0.1") == 200
+    assert list(gk.bans()) == []
@@ -0,0 +1,539 @@
+# tests for the storage backends
+import asyncio
+import multiprocessing
+import time
+
+import pytest
+from flask import Flask
+
+from .algorithms import GCRA, SlidingLog, SlidingWindowCounter
+from .clocks import FakeClock
+from .gatekeeper import GateKeeper
+from .reaper import Reaper
+from .snapshots import Snapshotter
+from .storage import MemoryStorage, RedisStorage, SharedMemoryStorage
+
+RULES = [{"count": 100, "window": 60}]
+
+
+def _worker_hits(path, results):
+    """hits a shared storage 50 times from another process"""
+    storage = SharedMemoryStorage(path=path, slots=64)
+    storage.bind(None, SlidingWindowCounter(RULES))
+    results.put(sum(storage.hit("10.1.0.1", 1000.0) is None for _ in range(50)))
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_shared_memory_across_processes(tmp_path):
+    path = str(tmp_path / "gk")
+    ctx = multiprocessing.get_context("fork")
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_worker_hits, args=(path, results)) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert sum(results.get() for _ in workers) == 100 # one limit for all the workers
+
+
+def test_shared_memory_gatekeepers(tmp_path):
+    path = str(tmp_path / "gk")
+    apps = []
+    for _ in range(2): # 2 apps, as if in 2 workers
+        app = Flask(__name__)
+        gk = GateKeeper(app, ip_header="x-my-ip",
+                        ban_rule={"count":3,"window":10,"duration":10},
+                        rate_limit_rules=[{"count":10,"window":60}],
+                        algorithm="sliding-window-counter",
+                        storage=SharedMemoryStorage(path=path, slots=64))
+
+        @app.route("/ping")
+        def ping():
+            return "ok", 200
+
+        @app.route("/ban")
+        def ban():
+            gk.report()
+            return "ok", 200
+        apps.append(app.test_client())
+
+    ip1 = {"x-my-ip": "10.1.1.1"}
+    ip2 = {"x-my-ip": "10.1.1.2"}
+    statuses = [apps[i % 2].get("/ping", headers=ip1).status_code for i in range(12)]
+    assert statuses.count(200) == 10 # the 10 requests are shared by both apps
+
+    for i in range(3):
+        apps[i % 2].get("/ban", headers=ip2)
+    assert apps[0].get("/ping", headers=ip2).status_code == 403
+    assert apps[1].get("/ping", headers=ip2).status_code == 403
+
+
+def test_shared_memory_admin_bans(tmp_path):
+    # without a ban rule, a ban set by a worker must still be seen by the others
+    path = str(tmp_path / "gk")
+    gks, clients = [], []
+    for _ in range(2):
+        app = Flask(__name__)
+        gks.append(GateKeeper(app, ip_header="x-my-ip", rate_limit_rules=[{"count":100,"window":60}], algorithm="gcra",
+                              storage=SharedMemoryStorage(path=path, slots=64)))
+
+        @app.route("/ping")
+        def ping():
+            return "ok", 200
+        clients.append(app.test_client())
+
+    ip = {"x-my-ip": "10.1.1.1"}
+    assert [client.get("/ping", headers=ip).status_code for client in clients] == [200, 200]
+    gks[0].ban("10.1.1.1", 60)
+    assert [client.get("/ping", headers=ip).status_code for client in clients] == [403, 403]
+    gks[1].unban("10.1.1.1")
+    assert [client.get("/ping", headers=ip).status_code for client in clients] == [200, 200]
+
+
+def test_shared_memory_eviction(tmp_path):
+    storage = SharedMemoryStorage(path=str(tmp_path / "gk"), slots=8)
+    storage.bind(None, SlidingWindowCounter([{"count": 1, "window": 60}]))
+    for i in range(20):
+        assert storage.hit("10.1.2.{}".format(i), storage.clock()) is None
+    stats = storage.stats()
+    assert stats["size"] == 8 # the table never grows
+    assert stats["evictions"] == 12
+
+    with pytest.raises(ValueError): # another layout can't reuse the same file
+        SharedMemoryStorage(path=str(tmp_path / "gk"), slots=16).bind(None, SlidingWindowCounter(RULES))
+    with pytest.raises(ValueError): # nor other rules with the same layout
+        SharedMemoryStorage(path=str(tmp_path / "gk"), slots=8).bind(None, SlidingWindowCounter([{"count": 2, "window": 60}]))
+    assert SharedMemoryStorage("myapp-gatekeeper").path.endswith("/myapp-gatekeeper") # in /dev/shm
+
+
+def test_shared_memory_needs_constant_memory_algorithm(tmp_path):
+    with pytest.raises(ValueError):
+        GateKeeper(rate_limit_rules=RULES, storage=SharedMemoryStorage(path=str(tmp_path / "gk")))
+
+
+@pytest.fixture()
+def fake_redis():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa") # fakeredis runs the Lua scripts with lupa
+    return fakeredis.FakeRedis()
+
+
+@pytest.mark.parametrize("algorithm_class", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_redis_matches_memory(fake_redis, algorithm_class):
+    rules = [{"count": 20, "window": 1}, {"count": 100, "window": 10}]
+    ban_rule = {"count": 3, "window": 10, "duration": 10}
+    redis_storage, memory_storage = RedisStorage(fake_redis), MemoryStorage()
+    for storage in (redis_storage, memory_storage):
+        storage.bind(ban_rule, algorithm_class(rules))
+
+    for i in range(300): # both storages take the same decisions
+        now = 1000 + i / 25
+        redis_limited, memory_limited = redis_storage.hit("10.2.0.1", now), memory_storage.hit("10.2.0.1", now)
+        assert (redis_limited is None) == (memory_limited is None)
+        if redis_limited:
+            assert redis_limited[:2] == memory_limited[:2]
+
+    for i in range(3):
+        assert redis_storage.ban_status("10.2.0.2", 1000 + i) is None
+        redis_storage.report("10.2.0.2", 1000 + i)
+    assert redis_storage.ban_status("10.2.0.2", 1003) == 9 # last report + duration
+    assert redis_storage.ban_status("10.2.0.3", 1003) is None
+
+
+def test_redis_gatekeeper(fake_redis):
+    app = Flask(__name__)
+    gk = GateKeeper(app, ip_header="x-my-ip", rate_limit_rules=[{"count":10,"window":60}], storage=RedisStorage(fake_redis))
+
+    @app.route("/specific")
+    @gk.specific(rate_limit_rules=[{"count":1,"window":60}])
+    def specific():
+        return "ok", 200
+
+    client = app.test_client()
+    ip1 = {"x-my-ip": "10.2.1.1"}
+    assert client.get("/specific", headers=ip1).status_code == 200
+    assert client.get("/specific", headers=ip1).status_code == 429 # the specific rule is in redis too
+    assert fake_redis.exists("gatekeeper:rate:10.2.1.1", "gatekeeper:specific:rate:10.2.1.1") == 2
+
+    # without a ban rule, the bans are checked by the rate limiting script, in the same round trip
+    assert not gk.checks_bans
+    gk.ban("10.2.1.2", 60)
+    banned = client.get("/specific", headers={"x-my-ip": "10.2.1.2"})
+    assert banned.status_code == 403 and banned.headers["Retry-After"] == "59"
+    assert client.get("/specific", headers={"x-my-ip": "10.2.1.3"}).status_code == 200
+
+
+def test_redis_asyncio_client():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    storage = RedisStorage(fakeredis.FakeAsyncRedis())
+    storage.bind({"count": 1, "window": 10, "duration": 10}, SlidingWindowCounter([{"count": 2, "window": 60}]))
+
+    async def scenario():
+        assert [await storage.hit_async("10.2.2.1", 1000.0) is None for _ in range(3)] == [True, True, False]
+        await storage.report_async("10.2.2.2", 1000.0)
+        assert await storage.ban_status_async("10.2.2.2", 1001.0) == 9
+
+    asyncio.run(scenario())
+    with pytest.raises(TypeError): # the admin operations are sync
+        storage.set_bans(["10.2.2.3"], 1100.0, 1000.0)
+
+
+def test_memory_record_is_compact():
+    storage = MemoryStorage()
+    storage.bind({"count": 3, "window": 10, "duration": 10}, GCRA(RULES))
+    storage.hit("10.2.3.1", 1000.0)
+    record = storage.ips["10.2.3.1"]
+    assert not hasattr(record, "__dict__")
+    assert record.ban_entries is None # only allocated once reported
+    storage.report("10.2.3.1", 1000.0)
+    assert list(record.ban_entries) == [1000000] # in ms
+
+
+def test_memory_scopes_share_records():
+    app = Flask(__name__)
+    gk = GateKeeper(app, ip_header="x-my-ip", rate_limit_rules=[{"count":10,"window":60}])
+
+    @app.route("/a")
+    @gk.specific(rate_limit_rules=[{"count":1,"window":60}])
+    def a():
+        return "ok", 200
+
+    @app.route("/b")
+    @gk.specific(rate_limit_rules=[{"count":2,"window":600}], standalone=True)
+    def b():
+        return "ok", 200
+
+    client = app.test_client()
+    ip1 = {"x-my-ip": "10.2.4.1"}
+    assert [client.get("/a", headers=ip1).status_code for _ in range(2)] == [200, 429]
+    assert [client.get("/b", headers=ip1).status_code for _ in range(3)] == [200, 200, 429]
+    assert len(gk.storage.ips) == 1 # a single record for the global and both specific rules
+    assert len(gk.storage.ips["10.2.4.1"].scope_states) == 2
+    assert gk.storage.ips.ttl == 600 # records live as long as the longest specific window
+
+
+def test_reaper():
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind(None, GCRA([{"count": 10, "window": 60}]), clock)
+    for i in range(200):
+        storage.hit("10.2.5.{}".format(i), clock())
+    clock.advance(30)
+    storage.hit("10.2.5.0", clock())
+    reaper = Reaper(storage, batch=16)
+    assert reaper.sweep() == 0 # nothing expired yet
+
+    clock.advance(31)
+    assert reaper.sweep() == 199 # in several batches, all but the recently seen client
+    assert len(storage.ips) == 1
+    stats = reaper.stats()
+    assert (stats["sweeps"], stats["reclaimed"], stats["last_reclaimed"]) == (2, 199, 199)
+    assert stats["last_duration"] > 0
+
+
+@pytest.mark.parametrize("algorithm", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_memory_storage_snapshot(tmp_path, algorithm):
+    path = str(tmp_path / "gatekeeper.snapshot")
+    ban_rule = {"count": 2, "window": 60, "duration": 600}
+
+    def storage_at(clock):
+        storage = MemoryStorage()
+        storage.bind(ban_rule, algorithm([{"count": 5, "window": 60}]), clock)
+        scope = storage.spawn("route")
+        scope.bind(None, algorithm([{"count": 2, "window": 60}]), clock)
+        return storage, scope
+
+    clock = FakeClock()
+    storage, scope = storage_at(clock)
+    for _ in range(5):
+        storage.hit("10.3.0.1", clock())
+    scope.hit("10.3.0.2", clock())
+    scope.hit("10.3.0.2", clock())
+    storage.report("10.3.0.3", clock())
+    storage.report("10.3.0.3", clock())
+    assert storage.ban_status("10.3.0.3", clock()) == 600
+    assert storage.save_snapshot(path) == 3
+
+    # restarted with another clock, the clients are restored when they come back
+    clock = FakeClock(start=50_000.0)
+    storage, scope = storage_at(clock)
+    snapshot = storage.load_snapshot(path)
+    clock.advance(10)
+    assert storage.hit("10.3.0.1", clock())
+    assert scope.hit("10.3.0.2", clock())
+    assert 589 < storage.ban_status("10.3.0.3", clock()) <= 590
+    assert storage.hit("10.3.0.4", clock()) is None
+    assert snapshot.restored == 3
+
+    # clients that have not come back yet are kept by the next snapshots
+    clock = FakeClock()
+    storage, scope = storage_at(clock)
+    storage.load_snapshot(path)
+    assert storage.save_snapshot(path) == 3
+    storage, scope = storage_at(clock)
+    storage.load_snapshot(path)
+    assert storage.ban_status("10.3.0.3", clock())
+
+    # with other rules, only the bans and reports are restored
+    storage = MemoryStorage()
+    storage.bind(ban_rule, algorithm([{"count": 6, "window": 60}]), clock)
+    storage.load_snapshot(path)
+    assert storage.hit("10.3.0.1", clock()) is None
+    assert storage.ban_status("10.3.0.3", clock())
+
+
+def test_memory_storage_snapshot_restores_once(tmp_path):
+    path = str(tmp_path / "gatekeeper.snapshot")
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind({"count": 1, "window": 60, "duration": 600}, None, clock)
+    storage.report("10.3.1.1", clock())
+    storage.report("10.3.1.2", clock())
+    assert storage.ban_status("10.3.1.1", clock()) and storage.ban_status("10.3.1.2", clock())
+    storage.save_snapshot(path)
+
+    storage = MemoryStorage(max_clients=1)
+    storage.bind({"count": 1, "window": 60, "duration": 600}, None, clock)
+    storage.load_snapshot(path)
+    assert storage.ban_status("10.3.1.1", clock())
+    storage.set_ban("10.3.1.1", None, clock())
+    storage.set_ban("10.3.1.2", None, clock()) # lifted before the client came back, evicts the first one
+    assert "10.3.1.1" not in storage.ips
+    assert storage.ban_status("10.3.1.1", clock()) is None
+    assert storage.ban_status("10.3.1.2", clock()) is None
+    # the lifted bans are not carried over either
+    storage.save_snapshot(path)
+    storage = MemoryStorage()
+    storage.bind({"count": 1, "window": 60, "duration": 600}, None, clock)
+    storage.load_snapshot(path)
+    assert storage.ban_status("10.3.1.1", clock()) is None
+    assert storage.ban_status("10.3.1.2", clock()) is None
+
+
+def test_memory_storage_snapshot_keeps_idle_bans(tmp_path):
+    path = str(tmp_path / "gatekeeper.snapshot")
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind(None, GCRA([{"count": 10, "window": 60}]), clock)
+    storage.set_ban("10.3.2.1", clock() + 600, clock())
+    clock.advance(120) # idle for longer than the ttl, but still banned
+    assert storage.save_snapshot(path) == 1
+    clock.advance(120)
+    assert storage.save_snapshot(path) == 1 # and by the next snapshots
+
+    storage = MemoryStorage()
+    storage.bind(None, GCRA([{"count": 10, "window": 60}]), clock)
+    storage.load_snapshot(path)
+    clock.advance(120) # the snapshot is older than the ttl
+    assert 239 < storage.ban_status("10.3.2.1", clock()) <= 240
+
+
+def test_memory_storage_snapshot_long_logs(tmp_path):
+    path = str(tmp_path / "gatekeeper.snapshot")
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind(None, SlidingLog([{"count": 70_000, "window": 3600}]), clock)
+    for _ in range(70_000): # more timestamps than a 16 bits count
+        assert storage.hit("10.3.3.1", clock()) is None
+    assert storage.save_snapshot(path) == 1
+
+    storage = MemoryStorage()
+    storage.bind(None, SlidingLog([{"count": 70_000, "window": 3600}]), clock)
+    storage.load_snapshot(path)
+    assert storage.hit("10.3.3.1", clock()) # the whole log was restored
+
+
+def test_snapshotter_survives_failures(tmp_path):
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind(None, GCRA([{"count": 10, "window": 60}]), clock)
+    snapshotter = Snapshotter(storage, str(tmp_path / "missing" / "gatekeeper.snapshot"), interval=0.01).start()
+    deadline = time.monotonic() + 5
+    while snapshotter.failures < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    snapshotter.stop()
+    assert snapshotter.failures >= 2 # the thread kept going after the first failure
+
+
+def test_gatekeeper_snapshot(tmp_path):
+    path = str(tmp_path / "gatekeeper.snapshot")
+    with pytest.raises(ValueError):
+        GateKeeper(storage=SharedMemoryStorage(path=str(tmp_path / "shm"), slots=64), snapshot_path=path)
+
+    app = Flask(__name__)
+    gk = GateKeeper(app, rate_limit_rules=[{"count": 2, "window": 60}], snapshot_path=path, snapshot_interval=3600)
+    client = app.test_client()
+    assert client.get("/").status_code == 404
+    assert client.get("/").status_code == 404
+    assert client.get("/").status_code == 429
+    gk.snapshotter.stop()
+    assert gk.snapshotter.save() == 1
+
+    app = Flask(__name__)
+    gk = GateKeeper(app, rate_limit_rules=[{"count": 2, "window": 60}], snapshot_path=path, snapshot_interval=3600)
+    assert app.test_client().get("/").status_code == 429
+    gk.ban("10.4.0.1", 600) # without a ban rule
+    gk.snapshotter.stop()
+    gk.snapshotter.save()
+
+    app = Flask(__name__)
+    gk = GateKeeper(app, rate_limit_rules=[{"count": 2, "window": 60}], snapshot_path=path, snapshot_interval=3600)
+    assert app.test_client().get("/", environ_base={"REMOTE_ADDR": "10.4.0.1"}).status_code == 403 # restored bans are enforced
+    gk.snapshotter.stop()
+
+
+def test_gatekeeper_journal(tmp_path):
+    path = str(tmp_path / "gatekeeper.journal")
+    app = Flask(__name__)
+    gk = GateKeeper(app, rate_limit_rules=[{"count": 2, "window": 60}], journal_path=path, journal_interval=3600)
+    gk.ban("10.4.0.2", 600)
+    gk.journal.close()
+
+    app = Flask(__name__)
+    gk = GateKeeper(app, rate_limit_rules=[{"count": 2, "window": 60}], journal_path=path, journal_interval=3600)
+    assert app.test_client().get("/", environ_base={"REMOTE_ADDR": "10.4.0.2"}).status_code == 403 # replayed bans are enforced
+    gk.journal.close()
+
+
+def test_memory_storage_journal(tmp_path):
+    path = str(tmp_path / "gatekeeper.journal")
+    ban_rule = {"count": 2, "window": 60, "duration": 600}
+
+    def storage_at(clock):
+        storage = MemoryStorage()
+        storage.bind(ban_rule, None, clock)
+        return storage
+
+    clock = FakeClock()
+    storage = storage_at(clock)
+    journal = storage.open_journal(path, compact_bytes=200)
+    storage.report("10.4.0.1", clock())
+    clock.advance(1)
+    storage.report("10.4.0.1", clock())
+    assert storage.ban_status("10.4.0.1", clock()) == 600
+    storage.report("10.4.0.2", clock())
+    assert journal.stats()["pending"] == 4 # nothing written before the flush
+    assert journal.flush() == 4
+
+    # replayed with another clock, twice is the same as once
+    clock = FakeClock(start=50_000.0)
+    storage = storage_at(clock)
+    journal = storage.open_journal(path)
+    assert journal.replay() == 0
+    clock.advance(10)
+    assert 589 < storage.ban_status("10.4.0.1", clock()) < 591
+    storage.report("10.4.0.2", clock())
+    assert storage.ban_status("10.4.0.2", clock()) == 600
+
+    # compacted once over compact_bytes, to the reports and bans that still matter
+    clock = FakeClock()
+    storage = storage_at(clock)
+    journal = storage.open_journal(path, compact_bytes=200)
+    for i in range(10):
+        storage.report("10.4.1.{}".format(i), clock())
+    clock.advance(61)
+    storage.report("10.4.0.3", clock())
+    journal.flush()
+    assert journal.stats()["compactions"] == 1
+    clock.advance(60)
+    storage = storage_at(clock)
+    storage.open_journal(path)
+    assert storage.ban_status("10.4.0.1", clock())
+    assert storage.ban_status("10.4.0.3", clock()) is None
+    assert len(storage.ips) == 2 # the ban of 10.4.0.1, the report of 10.4.0.3
+
+
+def test_memory_storage_journal_failures(tmp_path):
+    path = tmp_path / "missing" / "gatekeeper.journal"
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind({"count": 2, "window": 60, "duration": 600}, None, clock)
+    journal = storage.open_journal(str(path), flush_interval=0.01, max_pending=3).start()
+    for i in range(4):
+        storage.report("10.4.2.{}".format(i), clock())
+    deadline = time.monotonic() + 5
+    while journal.failures < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert journal.failures >= 2 # the writer kept going after the first failure
+    assert journal.stats()["pending"] == 3 and journal.stats()["dropped"] == 1 # the queue is capped
+
+    path.parent.mkdir() # the failed writes did not lose the queued events
+    journal.close()
+    assert journal.written == 3
+    storage = MemoryStorage()
+    storage.bind({"count": 2, "window": 60, "duration": 600}, None, clock)
+    storage.open_journal(str(path))
+    assert len(storage.ips) == 3
+
+
+@pytest.mark.parametrize("algorithm", [SlidingLog, SlidingWindowCounter, GCRA])
+def test_memory_fast_path(algorithm):
+    clock = FakeClock()
+    storage = MemoryStorage(fast_path=True)
+    storage.bind({"count": 1, "window": 60, "duration": 600}, algorithm([{"count": 10, "window": 60}]), clock)
+    for i in range(1000):
+        assert storage.hit("10.5.{}.{}".format(i // 256, i % 256), clock()) is None
+        assert storage.ban_status("10.5.{}.{}".format(i // 256, i % 256), clock()) is None
+    assert len(storage.ips) == 0 # a request each, nobody got a record
+
+    # a client approaching the rule gets a record, and is limited like without the fast path
+    for i in range(10):
+        assert storage.hit("10.5.9.1", clock()) is None
+        assert len(storage.ips) == (i >= 4)
+    assert storage.hit("10.5.9.1", clock())
+
+    storage.report("10.5.9.2", clock())
+    assert storage.ban_status("10.5.9.2", clock()) == 600
+
+
+def _storages(tmp_path, fake_redis=None):
+    """a storage of each kind, bound without a ban rule"""
+    storages = [MemoryStorage(), SharedMemoryStorage(path=str(tmp_path / "gk"), slots=64)]
+    if fake_redis is not None:
+        storages.append(RedisStorage(fake_redis))
+    for storage in storages:
+        storage.bind(None, None, FakeClock())
+    return storages
+
+
+def test_storage_set_bans(tmp_path):
+    pytest.importorskip("lupa")
+    fakeredis = pytest.importorskip("fakeredis")
+    ips = ["10.12.0.{}".format(i) for i in range(20)]
+    for storage in _storages(tmp_path, fakeredis.FakeRedis()):
+        storage.set_bans(ips, 1060, 1000)
+        assert storage.ban_statuses(ips[:2] + ["10.12.1.1"], 1000) == [60, 60, None]
+        storage.set_bans(ips[:10], None, 1000)
+        assert storage.ban_status("10.12.0.1", 1000) is None
+        assert storage.ban_status("10.12.0.11", 1000) == 60
+        if not isinstance(storage, SharedMemoryStorage):
+            assert sorted(storage.bans(1000)) == [(ip, 1060) for ip in sorted(ips[10:])]
+
+
+def test_memory_bans_outlast_ttl():
+    clock = FakeClock()
+    storage = MemoryStorage()
+    storage.bind(None, GCRA([{"count": 10, "window": 10}]), clock)
+    storage.set_ban("10.13.0.1", clock() + 60, clock())
+    storage.hit("10.13.0.2", clock())
+    clock.advance(30)
+    assert storage.reap(100) == 1 # 10.13.0.2 is forgotten, not the banned client
+    assert storage.ban_status("10.13.0.1", clock()) == 30
+
+
+def test_memory_bans_outlast_eviction():
+    clock = FakeClock()
+    storage = MemoryStorage(max_clients=100)
+    storage.bind(None, GCRA([{"count": 10, "window": 10}]), clock)
+    storage.set_bans(["10.14.0.{}".format(i) for i in range(100)], clock() + 3600, clock())
+    for i in range(1000): # a busy site, or a client rotating its addresses
+        storage.hit("10.15.{}.{}".format(i // 256, i % 256), clock())
+    assert storage.ips.stats()["held"] == 100 # banned clients are held aside, not evicted
+    assert len(list(storage.bans(clock()))) == 100
+    assert storage.ban_status("10.14.0.1", clock()) == 3600
+
+    clock.advance(3601) # once their bans end, they are forgotten like the others
+    storage.hit("10.16.0.1", clock())
+    assert storage.ips.stats()["held"] == 0
+    assert storage.ban_status("10.14.0.2", clock()) is None